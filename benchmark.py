@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Repeatable performance numbers for recursive_summarize.py. Replays the
+# bundled libpng sample against mock_server.py (in-process, with fixed latency
+# and no random errors, so the same prompts always get the same answers) and
+# reports wall time, API requests, tokens, prompts that were too long, and peak
+# memory as JSON, so results can be saved and compared across versions:
+#
+#   $ python benchmark.py -o before.json
+#   $ git checkout my-branch
+#   $ python benchmark.py -o after.json
+#
+# Each scenario runs in a fresh subprocess on a scratch copy of the sample, so
+# runs don't share tokenizer caches, sidecar indexes or memory high-water marks.
+# The completion cache is always off. Anything after -- is passed on to
+# recursive_summarize.py (e.g. -- -j 8 --batch-size 4).
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SAMPLE = os.path.join(HERE, 'samples', 'libpng16.so.16.38.0_stripped')
+# Scenario name -> -f target (None for the whole program)
+SCENARIOS = {
+    'full': None,
+    'png_read_info': 'png_read_info',
+}
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_one(args):
+    # Child side: run recursive_summarize.main() once and print the numbers
+    sys.path.insert(0, HERE)
+    import recursive_summarize
+    from mock_server import MockServer, MockConfig
+    config = MockConfig(latency=args.latency, latency_per_token=args.latency_per_token, jitter=0,
+                        response_tokens=args.response_tokens, max_context=args.max_context)
+    server = MockServer(config=config).start()
+    argv = ['recursive_summarize.py', '--backend', 'http', '--base-url', server.url, '--no-cache',
+            '-o', os.path.join(args.workdir, 'summaries.jsonl')]
+    if args.function is not None:
+        argv += ['-f', args.function]
+    argv += args.extra + [args.workdir]
+    sys.argv = argv
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        recursive_summarize.main()
+        wall = time.perf_counter() - start
+    server.stop()
+    with open(os.path.join(args.workdir, 'summaries.jsonl')) as f:
+        summarized = sum(1 for _ in f)
+    stats = recursive_summarize.STATS
+    print(json.dumps({
+        'wall_seconds': round(wall, 3),
+        'functions_summarized': summarized,
+        'api_requests': stats['requests'],
+        'prompt_tokens': stats['prompt_tokens'],
+        'generated_tokens': stats['generated_tokens'],
+        'overflow_retries': stats['overflows'],
+        # ru_maxrss is in KiB on Linux but bytes on macOS
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    }))
+
+def run_scenario(name, function, args):
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix='wpre-bench-') as workdir:
+            for filename in ('call_graph.json', 'decompilations.json'):
+                shutil.copy(os.path.join(args.sample, filename), workdir)
+            cmd = [sys.executable, os.path.abspath(__file__), '--run-one', '--workdir', workdir,
+                   '--latency', str(args.latency), '--latency-per-token', str(args.latency_per_token),
+                   '--response-tokens', str(args.response_tokens), '--max-context', str(args.max_context)]
+            if function is not None:
+                cmd += ['--function', function]
+            cmd += ['--'] + args.extra
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                sys.stderr.write(result.stderr)
+                raise SystemExit(f'Benchmark {name} failed')
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        print(f'{name}: {runs[-1]["wall_seconds"]:.2f}s, {runs[-1]["api_requests"]} requests', file=sys.stderr)
+    # Everything but the timings should be the same from run to run; report
+    # the median run and the spread of wall times
+    walls = [run['wall_seconds'] for run in runs]
+    result = dict(runs[walls.index(sorted(walls)[(len(walls) - 1) // 2])])
+    result['wall_seconds_all'] = walls
+    if len(walls) > 1:
+        result['wall_seconds_stdev'] = round(statistics.stdev(walls), 3)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark recursive_summarize.py against a deterministic mock model')
+    parser.add_argument('-o', '--output', default=None, help='Write results here (default: stdout)')
+    parser.add_argument('-s', '--scenario', choices=sorted(SCENARIOS), action='append', default=None,
+                        help='Scenario to run (default: all); can be repeated')
+    parser.add_argument('--sample', default=DEFAULT_SAMPLE, help='Directory with call_graph.json and decompilations.json')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Run each scenario this many times')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock model seconds per request')
+    parser.add_argument('--latency-per-token', type=float, default=0.0005,
+                        help='Mock model additional seconds per generated token')
+    parser.add_argument('--response-tokens', type=int, default=40, help='Length of each mock summary')
+    parser.add_argument('--max-context', type=int, default=4097, help='Mock model context length')
+    # Internal: run a single scenario in this process
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--function', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('extra', nargs='*', help='Extra arguments for recursive_summarize.py (after --)')
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args)
+        return
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        results[name] = run_scenario(name, SCENARIOS[name], args)
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'sample': os.path.basename(os.path.normpath(args.sample)),
+            'latency': args.latency,
+            'latency_per_token': args.latency_per_token,
+            'response_tokens': args.response_tokens,
+            'max_context': args.max_context,
+            'extra_args': args.extra,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
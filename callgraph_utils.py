@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import struct
+from array import array
+
+# Graph algorithms that need to cope with cycles in the call graph (mutual
+# recursion is common in parsers and interpreters, and graphlib just raises
+# CycleError on it).
+
+def strongly_connected_components(callgraph):
+    # Tarjan's algorithm, done iteratively so that long call chains don't run
+    # into the recursion limit. Linear in the size of the graph. Components
+    # come out callees-first, which is exactly the order we summarize them in.
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for root in callgraph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(callgraph[root]))]
+        while work:
+            func, callees = work[-1]
+            for callee in callees:
+                if callee not in index:
+                    index[callee] = lowlink[callee] = len(index)
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, iter(callgraph[callee])))
+                    break
+                elif callee in on_stack:
+                    lowlink[func] = min(lowlink[func], index[callee])
+            else:
+                # Done with all of func's callees
+                work.pop()
+                if work:
+                    caller = work[-1][0]
+                    lowlink[caller] = min(lowlink[caller], lowlink[func])
+                if lowlink[func] == index[func]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == func:
+                            break
+                    component.reverse()
+                    components.append(component)
+    return components
+
+def is_cyclic(component, callgraph):
+    return len(component) > 1 or component[0] in callgraph[component[0]]
+
+def condense(callgraph, components):
+    # Collapse each component to a single node; the result is a DAG over
+    # component indices, in the same {node: [callees]} form as the call graph
+    component_of = {}
+    for i, component in enumerate(components):
+        for func in component:
+            component_of[func] = i
+    dag = {}
+    for i, component in enumerate(components):
+        callees = set()
+        for func in component:
+            for callee in callgraph[func]:
+                callees.add(component_of[callee])
+        callees.discard(i)
+        dag[i] = sorted(callees)
+    return component_of, dag
+
+# Call graph with functions interned to integer IDs and the edges stored in CSR
+# form: the callees of function i are targets[offsets[i]:offsets[i+1]]. Next
+# to a dict of lists of strings this is a fraction of the size, loads from its
+# sidecar file without parsing any JSON, and lets us answer questions about a
+# 100k-function graph (what does -f need, in what order, how many descendants
+# does each function have) in milliseconds. The rest of the code still works
+# on {name: [callees]} dicts, so subgraph() and to_dict() hand those out.
+SIDECAR_MAGIC = b'WPRECSR\x01'
+
+class CompactCallGraph:
+    def __init__(self, names, offsets, targets, order=None, component_starts=None, descendants=None):
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.offsets = offsets
+        self.targets = targets
+        # See index() and descendant_counts()
+        self.order = order
+        self.component_starts = component_starts
+        self.descendants = descendants
+        # Where save() or load() last put us, as (path, signature)
+        self.sidecar = None
+
+    @classmethod
+    def from_dict(cls, callgraph):
+        names = list(callgraph)
+        ids = {name: i for i, name in enumerate(names)}
+        offsets = array('q', [0])
+        targets = array('i')
+        for name in names:
+            targets.extend(ids[callee] for callee in callgraph[name])
+            offsets.append(len(targets))
+        graph = cls(names, offsets, targets)
+        graph.index()
+        return graph
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def num_edges(self):
+        return len(self.targets)
+
+    def callees(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i+1]]
+
+    def index(self):
+        # Precompute the summary order: function IDs callees-first, with the
+        # members of each recursive cycle next to each other
+        adjacency = {i: self.callees(i) for i in range(len(self.names))}
+        self.order = array('i')
+        self.component_starts = array('i', [0])
+        for component in strongly_connected_components(adjacency):
+            self.order.extend(component)
+            self.component_starts.append(len(self.order))
+
+    def components(self):
+        starts = self.component_starts
+        return [self.order[starts[c]:starts[c+1]] for c in range(len(starts) - 1)]
+
+    def descendant_counts(self):
+        # Number of functions each function calls, directly or not (itself
+        # included if it's recursive). This is quadratic in the worst case,
+        # so it's only worked out when asked for; save() keeps it afterwards.
+        if self.descendants is not None:
+            return self.descendants
+        adjacency = {i: self.callees(i) for i in range(len(self.names))}
+        components = [list(component) for component in self.components()]
+        _, dag = condense(adjacency, components)
+        # Reachable sets as bitsets, built callees-first. A component's bitset
+        # is only needed until its last caller has been done, so drop it then.
+        callers_left = [0] * len(components)
+        for callees in dag.values():
+            for callee in callees:
+                callers_left[callee] += 1
+        reach = {}
+        self.descendants = array('i', bytes(4 * len(self.names)))
+        for c, component in enumerate(components):
+            bits = 0
+            for callee in dag[c]:
+                bits |= reach[callee]
+                callers_left[callee] -= 1
+                if callers_left[callee] == 0:
+                    del reach[callee]
+            count = bits.bit_count()
+            if is_cyclic(component, adjacency):
+                count += len(component)
+            for func in component:
+                self.descendants[func] = count
+            if callers_left[c]:
+                for func in component:
+                    bits |= 1 << func
+                reach[c] = bits
+        return self.descendants
+
+    def reachable(self, roots):
+        # IDs of the roots and everything they (transitively) call
+        seen = bytearray(len(self.names))
+        out = []
+        stack = [self.ids[root] for root in roots]
+        for i in stack:
+            seen[i] = 1
+        while stack:
+            i = stack.pop()
+            out.append(i)
+            for callee in self.targets[self.offsets[i]:self.offsets[i+1]]:
+                if not seen[callee]:
+                    seen[callee] = 1
+                    stack.append(callee)
+        return out
+
+    def subgraph(self, roots):
+        # Keep the original function order so results don't depend on how the
+        # subgraph was found
+        names = self.names
+        return {names[i]: [names[j] for j in self.callees(i)] for i in sorted(self.reachable(roots))}
+
+    def to_dict(self):
+        names = self.names
+        return {name: [names[j] for j in self.callees(i)] for i, name in enumerate(names)}
+
+    def topo_order(self):
+        names = self.names
+        return [names[i] for i in self.order]
+
+    def fan_out(self):
+        offsets = self.offsets
+        return [offsets[i+1] - offsets[i] for i in range(len(self.names))]
+
+    def fan_in(self):
+        counts = [0] * len(self.names)
+        for callee in self.targets:
+            counts[callee] += 1
+        return counts
+
+    def save(self, path, signature):
+        header = json.dumps({'signature': signature, 'byteorder': sys.byteorder, 'names': self.names,
+                             'edges': len(self.targets), 'components': len(self.component_starts) - 1,
+                             'descendants': self.descendants is not None}).encode()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(SIDECAR_MAGIC)
+                f.write(struct.pack('<Q', len(header)))
+                f.write(header)
+                for arr in (self.offsets, self.targets, self.order, self.component_starts, self.descendants):
+                    if arr is not None:
+                        arr.tofile(f)
+            os.replace(tmp, path)
+            self.sidecar = (path, signature)
+        except OSError:
+            # Not being able to cache the graph shouldn't stop us using it
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    @classmethod
+    def load(cls, path, signature):
+        # Returns None if there's no sidecar or it's out of date
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(SIDECAR_MAGIC)) != SIDECAR_MAGIC:
+                    return None
+                header_len, = struct.unpack('<Q', f.read(8))
+                header = json.loads(f.read(header_len))
+                if header['signature'] != signature or header['byteorder'] != sys.byteorder:
+                    return None
+                n = len(header['names'])
+                sections = [('q', n + 1), ('i', header['edges']), ('i', n), ('i', header['components'] + 1)]
+                if header['descendants']:
+                    sections.append(('i', n))
+                arrays = []
+                for typecode, count in sections:
+                    arr = array(typecode)
+                    arr.fromfile(f, count)
+                    arrays.append(arr)
+        except (OSError, ValueError, KeyError, EOFError, struct.error):
+            return None
+        graph = cls(header['names'], *arrays)
+        graph.sidecar = (path, signature)
+        return graph
+
+def file_signature(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime]
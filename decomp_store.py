@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import mmap
+from collections.abc import Mapping
+
+# Read-only {name: code} mapping over decompilations.json (or the extractor's
+# decompilations.jsonl) that only decodes the functions that are asked for.
+# The file is memory-mapped and indexed once, recording where each function's
+# code string starts and ends; the index is saved next to the file so later
+# runs start up in time proportional to the number of functions rather than
+# the size of the code. That matters with -f on a big binary, where we might
+# only ever look at a few dozen functions out of a multi-hundred-MB dump.
+#
+# Both formats are a series of "name": "code" pairs separated by braces,
+# commas and whitespace, so one scanner handles them. Entries with null code
+# (functions the extractor failed to decompile) are left out, and if a name
+# appears more than once the last one wins, same as loading it with json.
+
+# A JSON string, written so the regex engine doesn't need to backtrack. Raw
+# newlines aren't allowed in one, which keeps a cut-off line from swallowing the next.
+STRING_RE = rb'"[^"\\\n]*(?:\\.[^"\\\n]*)*"'
+ENTRY_RE = re.compile(rb'[\s{},]*(' + STRING_RE + rb')\s*:\s*(' + STRING_RE + rb'|null)', re.DOTALL)
+# What's left of a complete .json file after the last entry (or an empty one)
+JSON_END_RE = re.compile(rb'\s*{?\s*}\s*')
+SEPARATOR_RE = re.compile(rb'[\s{},]*')
+INDEX_VERSION = 2
+
+class DecompStore(Mapping):
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # Can't mmap an empty file
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.index = self.load_index()
+        if self.index is None:
+            self.index = self.build_index()
+            self.save_index()
+
+    def signature(self):
+        st = os.fstat(self.file.fileno())
+        return {'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('signature') != self.signature():
+            return None
+        return {name: tuple(span) for name, span in saved['index'].items()}
+
+    def save_index(self):
+        # Write then rename so a concurrent run never sees half an index
+        tmp = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'signature': self.signature(), 'index': self.index}, f)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            # Read-only directory or similar; we'll just index again next time
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def build_index(self):
+        index = {}
+        pos = 0
+        while True:
+            m = ENTRY_RE.match(self.mm, pos)
+            if m is None:
+                self.check_end(pos)
+                break
+            name = json.loads(m.group(1))
+            if m.group(2) == b'null':
+                index.pop(name, None)
+            else:
+                index[name] = m.span(2)
+            pos = m.end()
+        return index
+
+    def check_end(self, pos):
+        # The scanner stops at anything it doesn't recognize. For .json that
+        # has to be the closing brace; for .jsonl it can also be a partial
+        # last line from an interrupted extraction, but nothing before that.
+        if self.path.endswith('.jsonl'):
+            pos = SEPARATOR_RE.match(self.mm, pos).end()
+            if b'\n' not in self.mm[pos:].rstrip():
+                return
+        elif JSON_END_RE.fullmatch(self.mm, pos):
+            return
+        line = self.mm[:pos].count(b'\n') + 1
+        raise ValueError(f'{self.path}: truncated or malformed near line {line} (byte {pos})')
+
+    def __getitem__(self, name):
+        start, end = self.index[name]
+        return json.loads(self.mm[start:end])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.file.close()
@@ -1,5 +1,27 @@
 #!/usr/bin/env python
 
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--batch-size', type=int, default=0,
+                    help='Run the extraction inside Ghidra, sending back this many functions per round trip '
+                         '(default: 0, which drives Ghidra one call at a time over the bridge)')
+parser.add_argument('--rpc-timeout', type=int, default=600,
+                    help='Seconds to wait for each batch when using --batch-size')
+parser.add_argument('-w', '--workers', type=int, default=1,
+                    help='Number of decompilers to run in parallel inside Ghidra (requires --batch-size)')
+parser.add_argument('-t', '--timeout', type=int, default=60,
+                    help='Seconds to let the decompiler spend on each function (with --batch-size)')
+parser.add_argument('--retries', type=int, default=2,
+                    help='Retry functions that time out this many times, doubling the timeout each time')
+parser.add_argument('--jsonl', action='store_true',
+                    help='Stream results to call_graph.jsonl/decompilations.jsonl as they are produced, '
+                         'skipping functions that are already there')
+parser.add_argument('--flush-every', type=int, default=50,
+                    help='With --jsonl, flush output to disk after this many functions')
+args = parser.parse_args()
+if args.workers > 1 and args.batch_size <= 0:
+    parser.error('--workers requires --batch-size')
+
 import ghidra_bridge
 # Bring in all the Ghidra classes
 bridge = ghidra_bridge.GhidraBridge(namespace=globals(), hook_import=True)
@@ -17,64 +39,316 @@ currentProgram = getCurrentProgram()
 progName = currentProgram.getName()
 os.makedirs(progName, exist_ok=True)
 
-# Map function names to their objects
-funcNames = {}
-
-# Build the call graph
-callGraph = defaultdict(list)
-fm = currentProgram.getFunctionManager()
-functions = list(fm.getFunctions(True))
-for func in tqdm(functions, desc="Building call graph"):
-    # Get the function name
-    name = func.getName()
-    funcNames[name] = func
-    for calledFunc in func.getCalledFunctions(getMonitor()):
-        if calledFunc.isThunk(): continue
-        calledName = calledFunc.getName()
-        if calledName == name: continue
-        callGraph[name].append(calledName)
-callGraph = dict(callGraph)
-for func in functions:
-    name = func.getName()
-    if name not in callGraph and not func.isThunk():
-        callGraph[name] = []
-
-# Decompile all the functions
-decompiler = DecompInterface()
-
-# Pull decompiler options from the current program
-opt = DecompileOptions()
-opt.grabFromProgram(currentProgram)
-decompiler.setOptions(opt)
-
-missing = []
-decompiler.openProgram(currentProgram)
-decomps = {}
-for func in tqdm(functions, desc="Decompiling functions"):
-    name = func.getName()
-    decompResult = decompiler.decompileFunction(func, 0, getMonitor())
-    decompFunc = decompResult.getDecompiledFunction()
-    if not decompFunc:
-        missing.append(name)
-        continue
-    decomps[name] = decompFunc.getC()
-decompiler.closeProgram()
-
-# Save the decompilations
-with open(os.path.join(progName,"decompilations.json"), "w") as f:
-    json.dump(decomps, f)
-    f.write("\n")
-
-# Remove missing functions from the call graph
-for func in missing:
-    del callGraph[func]
-    for called in callGraph:
-        if func in callGraph[called]:
-            callGraph[called].remove(func)
-print(f"Missing {len(missing)} functions:")
-print(missing)
-
-# Save the call graph
-with open(os.path.join(progName,"call_graph.json"), "w") as f:
-    json.dump(callGraph, f)
-    f.write("\n")
+# Every attribute access on a bridged object is a round trip to Ghidra, which
+# adds up to several per function. In batch mode we instead install this
+# (Jython 2.7!) code on the Ghidra side and have it walk the functions and
+# decompile them there, sending back one JSON string per batch.
+SERVER_SCRIPT = '''
+import sys, json
+from ghidra.app.decompiler import DecompInterface, DecompileOptions
+from ghidra.util.task import TaskMonitor
+from java.util.concurrent import Callable, Executors, LinkedBlockingQueue
+
+class DecompileTask(Callable):
+    def __init__(self, work, index):
+        self.work = work
+        self.index = index
+
+    def call(self):
+        return self.work(self.index)
+
+class WpreExtractor(object):
+    def __init__(self, program):
+        self.program = program
+        self.functions = list(program.getFunctionManager().getFunctions(True))
+        # Each DecompInterface drives its own native decompiler process, so
+        # having several of them lets decompilation use more than one core
+        self.decompilers = []
+        self.idle = LinkedBlockingQueue()
+        self.executor = None
+
+    def function_names(self):
+        return json.dumps([func.getName() for func in self.functions])
+
+    def call_graph(self, indices):
+        out = []
+        for func in [self.functions[index] for index in json.loads(indices)]:
+            name = func.getName()
+            callees = []
+            for calledFunc in func.getCalledFunctions(TaskMonitor.DUMMY):
+                if calledFunc.isThunk(): continue
+                calledName = calledFunc.getName()
+                if calledName == name: continue
+                callees.append(calledName)
+            out.append([name, func.isThunk(), callees])
+        return json.dumps(out)
+
+    def start_workers(self, workers):
+        while len(self.decompilers) < workers:
+            decompiler = DecompInterface()
+            opt = DecompileOptions()
+            opt.grabFromProgram(self.program)
+            decompiler.setOptions(opt)
+            decompiler.openProgram(self.program)
+            self.decompilers.append(decompiler)
+            self.idle.put(decompiler)
+        if workers > 1 and self.executor is None:
+            self.executor = Executors.newFixedThreadPool(workers)
+
+    def decompile_one(self, index, timeout):
+        func = self.functions[index]
+        decompiler = self.idle.take()
+        try:
+            decompResult = decompiler.decompileFunction(func, timeout, TaskMonitor.DUMMY)
+        finally:
+            self.idle.put(decompiler)
+        decompFunc = decompResult.getDecompiledFunction()
+        if decompFunc:
+            return [index, func.getName(), decompFunc.getC(), 'ok', None]
+        status = 'timeout' if decompResult.isTimedOut() else 'failed'
+        return [index, func.getName(), None, status, decompResult.getErrorMessage()]
+
+    def decompile(self, indices, timeout, workers):
+        indices = json.loads(indices)
+        self.start_workers(workers)
+        work = lambda index: self.decompile_one(index, timeout)
+        if workers > 1:
+            tasks = [DecompileTask(work, index) for index in indices]
+            out = [future.get() for future in self.executor.invokeAll(tasks)]
+        else:
+            out = [work(index) for index in indices]
+        return json.dumps(out)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for decompiler in self.decompilers:
+            decompiler.closeProgram()
+        self.decompilers = []
+        self.idle.clear()
+
+def wpre_init(program):
+    sys.wpre_extractor = WpreExtractor(program)
+    return len(sys.wpre_extractor.functions)
+
+sys.wpre_init = wpre_init
+'''
+
+# Where results go. The default collects everything and writes the JSON files
+# at the end; with --jsonl each function is appended to a JSON Lines file as
+# soon as we have it (one {name: callees} or {name: code} object per line, with
+# null code for functions that failed to decompile), so a crash or a dropped
+# bridge connection only loses the last few functions, and rerunning the
+# script picks up where it left off.
+class JsonOutput:
+    def __init__(self):
+        self.callGraph = defaultdict(list)
+        self.decomps = {}
+        self.missing = []
+        # Nothing to resume
+        self.callGraphDone = set()
+        self.decompsDone = set()
+
+    def add_call_graph(self, name, callees, isThunk):
+        if callees:
+            self.callGraph[name].extend(callees)
+        if not isThunk:
+            self.callGraph[name]
+
+    def add_decomp(self, name, code):
+        if code is None:
+            self.missing.append(name)
+        else:
+            self.decomps[name] = code
+
+    def close(self):
+        # Save the decompilations
+        with open(os.path.join(progName,"decompilations.json"), "w") as f:
+            json.dump(self.decomps, f)
+            f.write("\n")
+
+        # Remove missing functions from the call graph
+        callGraph = dict(self.callGraph)
+        for func in self.missing:
+            callGraph.pop(func, None)
+            for called in callGraph:
+                if func in callGraph[called]:
+                    callGraph[called].remove(func)
+        print(f"Missing {len(self.missing)} functions:")
+        print(self.missing)
+
+        # Save the call graph
+        with open(os.path.join(progName,"call_graph.json"), "w") as f:
+            json.dump(callGraph, f)
+            f.write("\n")
+
+class JsonlOutput:
+    def __init__(self, flushEvery=50):
+        self.flushEvery = flushEvery
+        self.unflushed = 0
+        # Records are held here and written out whole, a batch at a time, so
+        # the files only ever end mid-line if we're killed partway through a write
+        self.pending = {}
+        self.missing = []
+        self.callGraphDone = self.load_done("call_graph.jsonl")
+        self.decompsDone = self.load_done("decompilations.jsonl")
+        if self.callGraphDone or self.decompsDone:
+            print(f"Resuming: {len(self.callGraphDone)} call graph entries and "
+                  f"{len(self.decompsDone)} decompilations already on disk")
+        self.callGraphFile = open(os.path.join(progName, "call_graph.jsonl"), "a")
+        self.decompsFile = open(os.path.join(progName, "decompilations.jsonl"), "a")
+
+    def load_done(self, filename):
+        done = set()
+        path = os.path.join(progName, filename)
+        if os.path.exists(path):
+            good = 0
+            with open(path, "rb") as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        done.update(json.loads(line))
+                    except ValueError:
+                        # A partial last line from a crash will be redone;
+                        # a bad line with more after it means something else
+                        # went wrong, so leave the file alone
+                        if f.read().strip():
+                            raise ValueError(f"{path}: malformed line {lineno}")
+                        break
+                    good += len(line)
+            # Cut it off so that what we append next starts on a line of its own
+            if good < os.path.getsize(path):
+                print(f"Discarding incomplete record at the end of {filename}")
+                with open(path, "r+b") as f:
+                    f.truncate(good)
+        return done
+
+    def write(self, f, obj):
+        self.pending.setdefault(f, []).append(json.dumps(obj) + "\n")
+        self.unflushed += 1
+        if self.unflushed >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        for f, lines in self.pending.items():
+            f.write("".join(lines))
+            f.flush()
+        self.pending = {}
+        self.unflushed = 0
+
+    def add_call_graph(self, name, callees, isThunk):
+        # Thunks only appear if they call something, same as above
+        if callees or not isThunk:
+            self.write(self.callGraphFile, {name: callees})
+
+    def add_decomp(self, name, code):
+        if code is None:
+            self.missing.append(name)
+        self.write(self.decompsFile, {name: code})
+
+    def close(self):
+        self.flush()
+        self.callGraphFile.close()
+        self.decompsFile.close()
+        # recursive_summarize.py drops missing functions from the call graph when it loads it
+        print(f"Missing {len(self.missing)} functions:")
+        print(self.missing)
+
+def extract_rpc(output):
+    # Map function names to their objects
+    funcNames = {}
+
+    # Build the call graph
+    fm = currentProgram.getFunctionManager()
+    functions = list(fm.getFunctions(True))
+    for func in tqdm(functions, desc="Building call graph"):
+        # Get the function name
+        name = func.getName()
+        funcNames[name] = func
+        if name in output.callGraphDone: continue
+        callees = []
+        for calledFunc in func.getCalledFunctions(getMonitor()):
+            if calledFunc.isThunk(): continue
+            calledName = calledFunc.getName()
+            if calledName == name: continue
+            callees.append(calledName)
+        output.add_call_graph(name, callees, func.isThunk())
+
+    # Decompile all the functions
+    decompiler = DecompInterface()
+
+    # Pull decompiler options from the current program
+    opt = DecompileOptions()
+    opt.grabFromProgram(currentProgram)
+    decompiler.setOptions(opt)
+
+    decompiler.openProgram(currentProgram)
+    for func in tqdm(functions, desc="Decompiling functions"):
+        name = func.getName()
+        if name in output.decompsDone: continue
+        decompResult = decompiler.decompileFunction(func, 0, getMonitor())
+        decompFunc = decompResult.getDecompiledFunction()
+        output.add_decomp(name, decompFunc.getC() if decompFunc else None)
+    decompiler.closeProgram()
+
+def extract_batched(output, batch_size, rpc_timeout, workers=1, timeout=60, retries=2):
+    bridge.remote_exec(SERVER_SCRIPT)
+    bridge.remote_eval("__import__('sys').wpre_init(program)", program=currentProgram)
+    def remote_call(expr, rpcTimeout=rpc_timeout, **kwargs):
+        return json.loads(bridge.remote_eval(expr, timeout_override=rpcTimeout, **kwargs))
+    names = remote_call("__import__('sys').wpre_extractor.function_names()")
+
+    pending = [index for index, name in enumerate(names) if name not in output.callGraphDone]
+    with tqdm(total=len(pending), desc="Building call graph") as pbar:
+        for i in range(0, len(pending), batch_size):
+            batch = remote_call("__import__('sys').wpre_extractor.call_graph(indices)",
+                                indices=json.dumps(pending[i:i+batch_size]))
+            for name, isThunk, callees in batch:
+                output.add_call_graph(name, callees, isThunk)
+                pbar.update(1)
+
+    # Decompile everything, then go back for anything that timed out with a
+    # longer timeout rather than quietly dropping it
+    pending = [index for index, name in enumerate(names) if name not in output.decompsDone]
+    for attempt in range(retries + 1):
+        timedOut = []
+        with tqdm(total=len(pending), desc="Decompiling functions" if attempt == 0 else f"Retrying ({timeout}s timeout)") as pbar:
+            # Give the bridge long enough for a whole batch of worst cases
+            rpcTimeout = max(rpc_timeout, timeout * -(-batch_size // workers))
+            for i in range(0, len(pending), batch_size):
+                batch = remote_call("__import__('sys').wpre_extractor.decompile(indices, timeout, workers)",
+                                    rpcTimeout=rpcTimeout, indices=json.dumps(pending[i:i+batch_size]),
+                                    timeout=timeout, workers=workers)
+                for index, name, code, status, error in batch:
+                    if status == 'timeout':
+                        timedOut.append(index)
+                    else:
+                        if status != 'ok':
+                            print(f"Failed to decompile {name}: {error}")
+                        output.add_decomp(name, code)
+                    pbar.update(1)
+        if not timedOut:
+            break
+        print(f"{len(timedOut)} functions timed out after {timeout}s")
+        pending = timedOut
+        timeout *= 2
+    else:
+        gaveUp = [names[index] for index in timedOut]
+        print(f"Gave up on {len(gaveUp)} functions that kept timing out:")
+        print(gaveUp)
+        for name in gaveUp:
+            output.add_decomp(name, None)
+    bridge.remote_eval("__import__('sys').wpre_extractor.close()")
+
+if args.jsonl:
+    output = JsonlOutput(flushEvery=args.flush_every)
+else:
+    output = JsonOutput()
+if args.batch_size > 0:
+    extract_batched(output, args.batch_size, args.rpc_timeout, workers=args.workers,
+                    timeout=args.timeout, retries=args.retries)
+else:
+    extract_rpc(output)
+output.close()
@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 
+import os
+import re
+import sys
 import json
+import html
+import hashlib
+import argparse
 import subprocess
-import sys
 import textwrap
 import shutil
+import functools
+import collections
 from io import StringIO
 
 from pygments import highlight, lexers, formatters
 from pygments.token import Token
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from decomp_store import DecompStore
+
 # These would need to be adjusted for your system / program
 base_addr = 0x100000
-if shutil.which('gaddr2line') is None:
-    addr2line = '/usr/local/Cellar/binutils/2.35/bin/gaddr2line'
-if shutil.which('gnm') is None:
-    nm = '/usr/local/Cellar/binutils/2.35/bin/gnm'
+addr2line = shutil.which('gaddr2line') or shutil.which('addr2line') or '/usr/local/Cellar/binutils/2.35/bin/gaddr2line'
+nm = shutil.which('gnm') or shutil.which('nm') or '/usr/local/Cellar/binutils/2.35/bin/gnm'
 
 # Ditto
 FILE_FROM = '/home/moyix/git/codex_add_assertions/'
@@ -29,78 +37,192 @@ def reloc(file):
 COLUMNS = 164
 BOX_WIDTH = 70
 
+# Symbol and source lookups are saved here, one file per binary (by hash), so
+# only the first look at a binary has to run nm and addr2line
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gpt-wpre', 'debug_index')
+INDEX_VERSION = 1
+IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=32)
+def read_lines(src_file):
+    with open(src_file) as f:
+        return f.readlines()
+
 # XXX: this is a very hacky way to pull out the source code for a function
 #      and it is certain to fail on anything except libpng. But I'll be
 #      damned if I'm going to lose another week of my ever-dwindling life
 #      to wrestling with tree-sitter.
-def func_source(func_name, src_file):
-    with open(src_file) as f:
-        lines = f.readlines()
-    start = None
-    end = None
+#
+# Finds every function we're interested in from one pass over the file: the
+# definition is a line starting with the function's name (the last one before
+# the line addr2line gave us, if there's more than one), and it ends at the
+# next line starting with '}'. Both ends are then widened out to the nearest
+# blank line to pick up comments and the return type. Returns {name: (first
+# line, last line)}, zero-based and inclusive.
+def function_spans(lines, wanted):
+    # wanted: {name: line number from addr2line, or None}
+    starts = collections.defaultdict(list)
     for i, line in enumerate(lines):
-        if start is None and line.startswith(func_name):
-            start = i
-        if start is not None and line.startswith('}'):
-            end = i
-            break
-    if start is None or end is None:
-        return None
-    # Move start back to last blank line
-    while start > 0 and lines[start-1].strip() != '':
-        start -= 1
-    # Move end forward to next blank line
-    while end < len(lines) and lines[end+1].strip() != '':
-        end += 1
-    return ''.join(lines[start:end+1])
+        m = IDENTIFIER_RE.match(line)
+        if m is not None and m.group() in wanted:
+            starts[m.group()].append(i)
+    next_close = [None] * (len(lines) + 1)
+    for i in range(len(lines) - 1, -1, -1):
+        next_close[i] = i if lines[i].startswith('}') else next_close[i+1]
+    spans = {}
+    for name, hint in wanted.items():
+        candidates = starts.get(name)
+        if not candidates:
+            continue
+        start = candidates[0]
+        if hint is not None:
+            start = max((i for i in candidates if i < hint), default=start)
+        end = next_close[start]
+        if end is None:
+            continue
+        # Move start back to last blank line
+        while start > 0 and lines[start-1].strip() != '':
+            start -= 1
+        # Move end forward to next blank line
+        while end + 1 < len(lines) and lines[end+1].strip() != '':
+            end += 1
+        spans[name] = (start, end)
+    return spans
 
 def get_syms_from_nm(binary):
-    p = subprocess.Popen([nm, '-n', binary], stdout=subprocess.PIPE, text=True)
-    out, err = p.communicate()
+    out = subprocess.run([nm, '-n', binary], stdout=subprocess.PIPE, text=True, check=True).stdout
     syms = {}
     for line in out.splitlines():
-        addr = line[:16].strip()
-        if addr == '':
+        # Undefined symbols have no address
+        parts = line.split()
+        if len(parts) != 3:
             continue
-        addr = int(addr, 16)
-        name = line[19:].strip()
-        syms[name] = addr
+        addr, kind, name = parts
+        if kind in 'TtWw':
+            syms[name] = int(addr, 16)
     return syms
 
-def lookup_addrs(binary, funcs):
-    syms = get_syms_from_nm(binary)
-    name_map = {}
-    names = []
-    addrs = []
-    for func in funcs:
-        if func.startswith('FUN_'):
-            addr = int(func[4:], 16) - base_addr
-            addrs.append(addr)
-            names.append(func)
-        else:
-            addr = syms[func]
-            addrs.append(addr)
-            names.append(func)
-    addrs = [hex(addr) for addr in addrs]
-    p = subprocess.Popen([addr2line, '-a', '-f', '-e', binary],
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-    out, err = p.communicate("\n".join(addrs))
+def run_addr2line(binary, addrs):
+    # One addr2line for the whole batch; returns {addr: (func, file, line)}
+    if not addrs:
+        return {}
+    p = subprocess.run([addr2line, '-a', '-f', '-e', binary], input='\n'.join(hex(addr) for addr in addrs),
+                       stdout=subprocess.PIPE, text=True, check=True)
     # Output is in the form:
     #   <addr>
     #   <function>
     #   <file>:<line>
-    lines = out.splitlines()
-    symbols = []
-    for i in range(0, len(lines), 3):
+    lines = p.stdout.splitlines()
+    results = {}
+    for i in range(0, len(lines) - 2, 3):
         addr = int(lines[i], 16)
         func = lines[i+1]
-        file, line = lines[i+2].split(':')
-        symbols.append( (addr, func, file, line) )
-    for name, (addr, func, file, line) in zip(names, symbols):
-        name_map[name] = (func, file, line)
-    return name_map
+        # e.g. "png.c:962 (discriminator 3)", or "??:0" without debug info
+        file, _, line = lines[i+2].split(' ')[0].rpartition(':')
+        results[addr] = (None if func == '??' else func, None if file == '??' else file,
+                         int(line) if line.isdigit() and line != '0' else None)
+    return results
+
+# Everything we need to know about the binary to line functions up with their
+# source: symbol -> address from nm, address -> (function, file, line) from
+# addr2line, and where each function is in each source file. Built once per
+# binary and kept on disk; addresses and source files are added to it as they
+# come up, and source spans are redone if the file changes.
+class DebugIndex:
+    def __init__(self, binary, index_dir=DEFAULT_INDEX_DIR, rebuild=False):
+        self.binary = binary
+        self.hash = file_hash(binary)
+        self.path = os.path.join(index_dir, f'{self.hash}.json') if index_dir else None
+        self.dirty = False
+        self.index = None if rebuild else self.load()
+        if self.index is None:
+            self.build()
 
-def side_by_side_highlight(title1, title2, code1, code2, lexer, formatter, width=(COLUMNS-4)//2):
+    def load(self):
+        if self.path is None:
+            return None
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get('version') != INDEX_VERSION or index.get('binary') != self.hash:
+            return None
+        return index
+
+    def build(self):
+        syms = get_syms_from_nm(self.binary)
+        lines = run_addr2line(self.binary, sorted(set(syms.values())))
+        self.index = {
+            'version': INDEX_VERSION,
+            'binary': self.hash,
+            'symbols': syms,
+            'lines': {str(addr): list(loc) for addr, loc in lines.items()},
+            'files': {},
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty or self.path is None:
+            return
+        # Write then rename so a concurrent run never sees half an index
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def address(self, func):
+        if func.startswith('FUN_'):
+            return int(func[4:], 16) - base_addr
+        return self.index['symbols'].get(func)
+
+    def locate(self, funcs):
+        # {func: (real name, source file, line)}; anything not already in the
+        # index is looked up in a single addr2line run
+        addrs = {func: self.address(func) for func in funcs}
+        known = self.index['lines']
+        missing = sorted({addr for addr in addrs.values() if addr is not None and str(addr) not in known})
+        if missing:
+            for addr, loc in run_addr2line(self.binary, missing).items():
+                known[str(addr)] = list(loc)
+            self.dirty = True
+        return {func: tuple(known[str(addr)]) if addr is not None and str(addr) in known else (None, None, None)
+                for func, addr in addrs.items()}
+
+    def source(self, real_name, src_file, src_line):
+        path = reloc(src_file)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signature = [st.st_size, st.st_mtime]
+        entry = self.index['files'].get(path)
+        if entry is None or entry['signature'] != signature or real_name not in entry['spans']:
+            # Index every function addr2line put in this file in one go
+            wanted = {func: line for func, file, line in self.index['lines'].values()
+                      if file == src_file and func is not None}
+            wanted[real_name] = src_line
+            spans = function_spans(read_lines(path), wanted)
+            # Remember the ones we couldn't find, too, so we don't keep looking
+            entry = {'signature': signature, 'spans': {name: spans.get(name) for name in wanted}}
+            self.index['files'][path] = entry
+            self.dirty = True
+        span = entry['spans'].get(real_name)
+        if span is None:
+            return None
+        start, end = span
+        return ''.join(read_lines(path)[start:end+1])
+
+def side_by_side_highlight(title1, title2, code1, code2, lexer, formatter, width=(COLUMNS-4)//2, file=sys.stdout):
     # Strip trailing whitespace up front so we don't have to worry about it
     code1 = code1.strip()
     code2 = code2.strip()
@@ -115,8 +237,8 @@ def side_by_side_highlight(title1, title2, code1, code2, lexer, formatter, width
     assert len(code2_lines) == len(hcode2_lines)
 
     # Print the titles centered in each column
-    print(title1.center(width) + ' | ' + title2.center(width))
-    print('-'*(width*2+3))
+    print(title1.center(width) + ' | ' + title2.center(width), file=file)
+    print('-'*(width*2+3), file=file)
     for i in range(max(len(code1_lines), len(code2_lines))):
         line1 = code1_lines[i] if i < len(code1_lines) else ''
         line2 = code2_lines[i] if i < len(code2_lines) else ''
@@ -124,59 +246,154 @@ def side_by_side_highlight(title1, title2, code1, code2, lexer, formatter, width
         hline2 = hcode2_lines[i] if i < len(hcode2_lines) else ''
         # Use the unhighlighted lines to determine how much to pad
         pad = width - len(line1)
-        print(hline1 + ' '*pad + ' | ' + hline2)
+        print(hline1 + ' '*pad + ' | ' + hline2, file=file)
 
-def main():
-    if len(sys.argv) < 4:
-        print(f'Usage: {sys.argv[0]} <binary> <summaries.json> <decompilations.json>')
-        sys.exit(1)
+# Reports are written a function at a time (and flushed), so they can be
+# piped into a pager or opened in a browser while the rest is still coming.
+# Each gets the function, what we know about it, and the problem if there's
+# something missing.
+class TerminalReport:
+    def __init__(self, out):
+        self.out = out
+        self.formatter = formatters.Terminal256Formatter(style='monokai')
+        self.lexer = lexers.get_lexer_by_name('c')
 
-    formatter = formatters.Terminal256Formatter(style='monokai')
-    lexer = lexers.get_lexer_by_name('c')
-    def bold(s):
+    def bold(self, s):
         sio = StringIO()
-        formatter.format([(Token.Generic.Strong, s)], sio)
+        self.formatter.format([(Token.Generic.Strong, s)], sio)
         return sio.getvalue()
 
-    binary = sys.argv[1]
-    summaries = {}
-    with open(sys.argv[2]) as f:
-        for line in f:
-            summaries.update(json.loads(line))
-    with open(sys.argv[3]) as f:
-        decompilations = json.load(f)
+    def begin(self, title):
+        pass
 
-    name_map = lookup_addrs(binary, summaries.keys())
-    for func, summary in summaries.items():
-        real_name, src_file, src_line = name_map[func]
-        print(f' {func} '.center(COLUMNS, '='))
-        print()
-        print(f'Real name: {real_name}'.center(COLUMNS))
-        print()
-        print(bold('OpenAI text-davinci-003 Summary'.center(COLUMNS)))
+    def function(self, func, summary, real_name, src_title, code, decomp, problem):
+        out = self.out
+        print(f' {func} '.center(COLUMNS, '='), file=out)
+        print(file=out)
+        print(f'Real name: {real_name}'.center(COLUMNS), file=out)
+        print(file=out)
+        print(self.bold('OpenAI text-davinci-003 Summary'.center(COLUMNS)), file=out)
         # Print the summary, wrapped at BOX_WIDTH columns, in a box
         summary = textwrap.fill(summary.strip(), BOX_WIDTH)
         left_pad = ' '*((COLUMNS-(BOX_WIDTH+4))//2)
         box_line = left_pad + '+' + '-'*(BOX_WIDTH+2) + '+'
-        print(box_line)
+        print(box_line, file=out)
         for line in summary.splitlines():
-            print(left_pad + '| ' + bold(line.ljust(BOX_WIDTH)) + ' |')
-        print(box_line)
-        print()
-        if src_file:
+            print(left_pad + '| ' + self.bold(line.ljust(BOX_WIDTH)) + ' |', file=out)
+        print(box_line, file=out)
+        print(file=out)
+        if problem:
+            print(problem, file=out)
+        elif code is not None:
+            side_by_side_highlight(src_title, f'Decompilation: {func}', code, decomp, self.lexer, self.formatter,
+                                   file=out)
+            print(file=out)
+        out.flush()
+
+    def end(self):
+        pass
+
+class HtmlReport:
+    STYLE = '''body { font-family: sans-serif; margin: 2em; }
+section { border-top: 1px solid #ccc; padding: 0.5em 0; }
+h2 { font-family: monospace; margin: 0.3em 0; }
+h2 small { font-weight: normal; color: #666; }
+blockquote { background: #f4f4f4; border-left: 4px solid #888; margin: 0.5em 0; padding: 0.5em 1em; max-width: 60em; }
+table.side { width: 100%; table-layout: fixed; border-collapse: collapse; }
+table.side td { vertical-align: top; width: 50%; overflow-x: auto; }
+.problem { color: #a00; }
+'''
+
+    def __init__(self, out):
+        self.out = out
+        self.formatter = formatters.HtmlFormatter()
+        self.lexer = lexers.get_lexer_by_name('c')
+
+    def begin(self, title):
+        self.out.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>\n'
+                       f'<style>\n{self.STYLE}{self.formatter.get_style_defs(".highlight")}\n</style></head>\n'
+                       f'<body><h1>{html.escape(title)}</h1>\n')
+        self.out.flush()
+
+    def function(self, func, summary, real_name, src_title, code, decomp, problem):
+        # Code is folded away so that pages with thousands of functions stay quick
+        parts = [f'<section id="{html.escape(func)}"><h2><a href="#{html.escape(func)}">{html.escape(func)}</a>']
+        if real_name and real_name != func:
+            parts.append(f' <small>{html.escape(real_name)}</small>')
+        parts.append(f'</h2>\n<blockquote>{html.escape(summary.strip())}</blockquote>\n')
+        if problem:
+            parts.append(f'<p class="problem">{html.escape(problem)}</p>\n')
+        elif code is not None:
+            parts.append(f'<details><summary>Source and decompilation</summary><table class="side"><tr>'
+                         f'<th>{html.escape(src_title)}</th><th>Decompilation: {html.escape(func)}</th></tr>'
+                         f'<tr><td>{highlight(code.strip(), self.lexer, self.formatter)}</td>'
+                         f'<td>{highlight(decomp.strip(), self.lexer, self.formatter)}</td></tr></table></details>\n')
+        parts.append('</section>\n')
+        self.out.write(''.join(parts))
+        self.out.flush()
+
+    def end(self):
+        self.out.write('</body></html>\n')
+        self.out.flush()
+
+REPORTS = {
+    'terminal': TerminalReport,
+    'html': HtmlReport,
+}
+
+def write_report(report, index, summaries, decompilations):
+    name_map = index.locate(summaries.keys())
+    for func, summary in summaries.items():
+        real_name, src_file, src_line = name_map[func]
+        src_title = code = decomp = problem = None
+        if real_name is None:
+            problem = f'Failed to find {func} in the binary'
+        elif src_file:
             relpath = src_file.replace(FILE_FROM, '')
-            reloc_sf = reloc(src_file)
-            code = func_source(real_name, reloc_sf)
-            if not code:
-                print(f'Failed to find source for {real_name}')
-                continue
+            src_title = f'{relpath}:{src_line}'
+            code = index.source(real_name, src_file, src_line)
             decomp = decompilations.get(func, None)
-            if not decomp:
-                print(f'Failed to find decompilation for {func}')
-                continue
-            side_by_side_highlight(f'{relpath}:{src_line}', f'Decompilation: {func}', code, decomp, lexer, formatter)
-        print()
+            if not code:
+                problem = f'Failed to find source for {real_name}'
+            elif not decomp:
+                problem = f'Failed to find decompilation for {func}'
+        report.function(func, summary, real_name, src_title, code, decomp, problem)
+
+def main():
+    parser = argparse.ArgumentParser(description='Show summaries next to the original source and the decompilation')
+    parser.add_argument('binary', help='The binary, with debug info')
+    parser.add_argument('summaries', help='summaries.jsonl from recursive_summarize.py')
+    parser.add_argument('decompilations', help='decompilations.json(l) for the stripped binary')
+    parser.add_argument('--format', choices=sorted(REPORTS), default='terminal')
+    parser.add_argument('--html', dest='format', action='store_const', const='html', help='Same as --format html')
+    parser.add_argument('-o', '--output', default=None, help='Write the report here (default: stdout)')
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR,
+                        help='Where to keep symbol and source indexes (default: ~/.cache/gpt-wpre/debug_index)')
+    parser.add_argument('--rebuild-index', action='store_true', help='Ignore any saved index for this binary')
+    args = parser.parse_args()
+
+    summaries = {}
+    with open(args.summaries) as f:
+        for line in f:
+            summaries.update(json.loads(line))
+    decompilations = DecompStore(args.decompilations)
+    index = DebugIndex(args.binary, args.index_dir, rebuild=args.rebuild_index)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    report = REPORTS[args.format](out)
+    try:
+        report.begin(os.path.basename(args.summaries))
+        write_report(report, index, summaries, decompilations)
+        report.end()
+    except BrokenPipeError:
+        # The pager was closed; not an error. Point stdout somewhere harmless
+        # so Python doesn't complain again on the way out.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        index.save()
+        decompilations.close()
+        if out is not sys.stdout:
+            out.close()
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,127 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from callgraph_utils import strongly_connected_components, is_cyclic
+
+# Fingerprints identify a function by what it does rather than where it lives,
+# so that the same statically linked zlib/libc/crypto code gets the same
+# fingerprint in every binary we look at, even though Ghidra calls it
+# FUN_00119fb0 in one and FUN_0021a3c0 in the next.
+#
+# A function's fingerprint hashes its normalized decompilation together with
+# the fingerprints of its callees, so two functions only match if their whole
+# call subtrees match (which is what their summaries depend on).
+
+IDENT_RE = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]*\b')
+COMMENT_RE = re.compile(r'/\*.*?\*/|//[^\n]*', re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+# Ghidra's auto-generated names for locals: uVar1, pcVar2, local_38, auStack_48,
+# in_RAX, extraout_EDX, unaff_RBX, joined_r0x0010..., stack0x00000008, ...
+LOCAL_RE = re.compile(r'^(?:[a-z]*Var\d+|local_\w+|[a-z]*Stack_?[0-9a-f]+|in_\w+|extraout_\w+|unaff_\w+|joined_\w+|stack0x[0-9a-f]+)$')
+# ...and for things at addresses: FUN_, DAT_, LAB_, PTR_DAT_, s_foo_00123456,
+# switchD_00106abc::caseD_1, and so on. They all embed the address.
+# Numeric literals are left alone: big ones are flags, masks and PNG-style
+# chunk tags far more often than addresses, which Ghidra prints as labels.
+ADDRESS_LABEL_RE = re.compile(r'[0-9a-f]{6,}')
+
+def normalize_decomp(decomp, name, callees):
+    # Returns the normalized code and the callees in the order they're first
+    # referenced, so the caller can mix in their fingerprints in that order
+    code = COMMENT_RE.sub(' ', decomp)
+    callees = set(callees)
+    callee_order = []
+    renames = {}
+    def rename(m):
+        ident = m.group(0)
+        if ident in renames:
+            return renames[ident]
+        if ident == name:
+            new = 'SELF'
+        elif ident in callees:
+            new = f'CALLEE{len(callee_order)}'
+            callee_order.append(ident)
+        elif LOCAL_RE.match(ident):
+            new = f'VAR{len(renames)}'
+        elif ADDRESS_LABEL_RE.search(ident):
+            new = f'LABEL{len(renames)}'
+        else:
+            # Keywords, types, parameters (param_N is positional, so stable)
+            # and imported/named symbols stay as they are
+            return ident
+        renames[ident] = new
+        return new
+    code = IDENT_RE.sub(rename, code)
+    code = WHITESPACE_RE.sub(' ', code).strip()
+    return code, callee_order
+
+def compute_fingerprints(callgraph, decompilations):
+    fingerprints = {}
+    for component in strongly_connected_components(callgraph):
+        members = set(component)
+        normalized = {func: normalize_decomp(decompilations[func], func, callgraph[func]) for func in component}
+        cycle_digest = b''
+        if is_cyclic(component, callgraph):
+            # Members of a recursive cycle can't wait for each other's
+            # fingerprints, so fingerprint the cycle as a whole (its members'
+            # code in a name-independent order, plus everything it calls out
+            # to) and mix that into each member's own fingerprint below
+            h = hashlib.sha256()
+            for code, _ in sorted(normalized.values()):
+                h.update(b'\2' + code.encode())
+            for fp in sorted(fingerprints[callee] for func in component
+                             for callee in callgraph[func] if callee not in members):
+                h.update(b'\1' + fp.encode())
+            cycle_digest = h.digest()
+        for func in component:
+            code, callee_order = normalized[func]
+            callee_fps = [fingerprints.get(callee, 'CYCLE') for callee in callee_order]
+            # Callees that never show up in the text (e.g. called through a
+            # thunk) still matter; add them in a name-independent order
+            unseen = sorted(fingerprints.get(callee, 'CYCLE') for callee in callgraph[func] if callee not in callee_order)
+            h = hashlib.sha256(cycle_digest + code.encode())
+            for fp in callee_fps:
+                h.update(b'\0' + fp.encode())
+            for fp in unseen:
+                h.update(b'\1' + fp.encode())
+            fingerprints[func] = h.hexdigest()
+    return fingerprints
+
+# Summaries keyed by fingerprint, shared across every binary we summarize
+class FingerprintStore:
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS summaries (
+            fingerprint TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            name TEXT,
+            program TEXT,
+            created REAL NOT NULL
+        )''')
+
+    def get(self, fingerprint):
+        with self.lock:
+            row = self.conn.execute('SELECT summary FROM summaries WHERE fingerprint = ?', (fingerprint,)).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, fingerprint, summary, name=None, program=None):
+        with self.lock:
+            # Keep whichever summary got there first so results are stable
+            self.conn.execute('INSERT OR IGNORE INTO summaries VALUES (?, ?, ?, ?, ?)',
+                              (fingerprint, summary, name, program, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,135 @@
+import os
+import threading
+
+# Where completions come from. recursive_summarize.py only ever needs "complete
+# this prompt with these parameters", so that's all a backend does; everything
+# else (caching, rate limiting, prompt budgeting) happens before we get here.
+# Backends raise the exceptions below rather than their library's own so the
+# caller can retry and fall back the same way whichever one is in use.
+
+class BackendError(Exception):
+    pass
+
+class RateLimitError(BackendError):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ContextLengthError(BackendError):
+    pass
+
+class TransientError(BackendError):
+    # Server errors and dropped connections; worth trying again
+    pass
+
+class DeadlineExceeded(TransientError):
+    pass
+
+DEFAULT_BASE_URL = 'https://api.openai.com/v1'
+
+# Both backends take timeout, the number of seconds to wait for any one
+# response (None: no limit), and raise DeadlineExceeded when it runs out.
+
+# The original backend: the openai package's (pre-1.0) Completion API
+class OpenAIBackend:
+    def __init__(self, base_url=None, api_key=None, timeout=None, **kwargs):
+        import openai
+        self.openai = openai
+        self.timeout = timeout
+        if base_url is not None:
+            openai.api_base = base_url
+        # Where completions come from; part of the completion cache key
+        self.base_url = openai.api_base.rstrip('/')
+        if api_key is not None:
+            openai.api_key = api_key
+
+    def complete(self, model, prompt, max_tokens, temperature, top_p, stop):
+        openai = self.openai
+        try:
+            response = openai.Completion.create(
+                engine=model,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                stop=stop,
+                request_timeout=self.timeout
+            )
+        except openai.error.Timeout as e:
+            raise DeadlineExceeded(str(e))
+        except openai.error.RateLimitError as e:
+            raise RateLimitError(str(e))
+        except openai.error.InvalidRequestError as e:
+            if 'maximum context length' in str(e):
+                raise ContextLengthError(str(e))
+            raise
+        except (openai.error.APIError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError) as e:
+            raise TransientError(str(e))
+        return response['choices'][0]['text']
+
+    def close(self):
+        pass
+
+# Talks to any OpenAI-compatible /completions endpoint (the real API, a
+# self-hosted server, or mock_server.py) over one pool of keep-alive
+# connections shared by every worker thread, instead of setting up a new
+# request each time.
+class HTTPBackend:
+    def __init__(self, base_url=DEFAULT_BASE_URL, api_key=None, pool_size=10, timeout=600):
+        import requests
+        self.requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.url = self.base_url + '/completions'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        api_key = api_key or os.environ.get('OPENAI_API_KEY')
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+
+    def complete(self, model, prompt, max_tokens, temperature, top_p, stop):
+        payload = {
+            'model': model,
+            'prompt': prompt,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'top_p': top_p,
+            'stop': stop,
+        }
+        with self.lock:
+            self.requests_sent += 1
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        except self.requests.Timeout as e:
+            raise DeadlineExceeded(str(e))
+        except self.requests.ConnectionError as e:
+            raise TransientError(str(e))
+        if response.status_code == 200:
+            return response.json()['choices'][0]['text']
+        try:
+            message = response.json()['error']['message']
+        except (ValueError, KeyError, TypeError):
+            message = response.text
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            raise RateLimitError(message, retry_after=float(retry_after) if retry_after else None)
+        if response.status_code == 400 and 'maximum context length' in message:
+            raise ContextLengthError(message)
+        if response.status_code >= 500:
+            raise TransientError(f'{response.status_code}: {message}')
+        raise BackendError(f'{response.status_code}: {message}')
+
+    def close(self):
+        self.session.close()
+
+BACKENDS = {
+    'openai': OpenAIBackend,
+    'http': HTTPBackend,
+}
+
+def make_backend(name, **kwargs):
+    return BACKENDS[name](**kwargs)
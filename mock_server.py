@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Stand-in for an OpenAI-compatible /v1/completions endpoint, for trying out
+# recursive_summarize.py (and tuning --jobs, --rpm, --batch-size, ...) without
+# a network connection or an API bill:
+#
+#   $ python mock_server.py --latency 1.5 --rpm 120 &
+#   $ python recursive_summarize.py --backend http --base-url http://127.0.0.1:8000/v1 ...
+#
+# Responses are made up but deterministic (the same prompt always gets the
+# same answer), and the server simulates the things that matter for
+# throughput: per-request and per-token latency, rate limiting with 429s, and
+# context-length errors. GET /stats returns counters as JSON.
+
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Close enough to a BPE token count for code and English; errs on the low side
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+BATCH_FUNCTION_RE = re.compile(r'^Function (\S+):$', re.MULTILINE)
+WORDS = ('the function', 'checks', 'a pointer', 'the buffer', 'computes', 'a checksum', 'calls', 'an error handler',
+         'initializes', 'the structure', 'reads', 'a chunk', 'writes', 'the header', 'returns', 'a status code')
+
+def count_tokens(text):
+    return len(TOKEN_RE.findall(text))
+
+def fake_summary(seed, tokens):
+    rng = random.Random(seed)
+    words = []
+    while count_tokens(' '.join(words)) < tokens - 2:
+        words.append(rng.choice(WORDS))
+    return 'This ' + ' '.join(words) + '.'
+
+class MockConfig:
+    def __init__(self, latency=0.5, latency_per_token=0.01, jitter=0.2, rpm=None, error_rate=0.0,
+                 server_error_rate=0.0, max_context=4097, response_tokens=40, seed=0, slow_rate=0.0, slow_latency=30.0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.jitter = jitter
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.max_context = max_context
+        self.response_tokens = response_tokens
+        self.seed = seed
+        # Stragglers: this fraction of requests take slow_latency seconds
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so pooled clients can reuse connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, error_type, headers=None):
+        self.server.count(f'status_{status}')
+        self.send_json(status, {'error': {'message': message, 'type': error_type}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self.send_json(200, self.server.snapshot())
+        else:
+            self.send_error_json(404, f'No route for {self.path}', 'invalid_request_error')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/completions'):
+            self.send_error_json(404, f'No route for {self.path}', 'invalid_request_error')
+            return
+        try:
+            request = json.loads(body)
+            prompt = request['prompt']
+            max_tokens = int(request.get('max_tokens', 16))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error_json(400, f'Bad request: {e}', 'invalid_request_error')
+            return
+        self.server.count('requests')
+        config = self.server.config
+
+        retry_after = self.server.take_rate_limit()
+        if retry_after is not None:
+            self.send_error_json(429, 'Rate limit reached for requests', 'requests',
+                                 {'Retry-After': f'{retry_after:.2f}'})
+            return
+        rng = self.server.rng()
+        if rng.random() < config.error_rate:
+            self.send_error_json(429, 'The server is currently overloaded with other requests', 'server_error',
+                                 {'Retry-After': '1'})
+            return
+        if rng.random() < config.server_error_rate:
+            self.send_error_json(500, 'The server had an error while processing your request', 'server_error')
+            return
+
+        prompt_tokens = count_tokens(prompt)
+        if prompt_tokens + max_tokens > config.max_context:
+            self.send_error_json(400, f"This model's maximum context length is {config.max_context} tokens, "
+                                      f"however you requested {prompt_tokens + max_tokens} tokens "
+                                      f"({prompt_tokens} in your prompt; {max_tokens} for the completion). "
+                                      f"Please reduce your prompt; or completion length.",
+                                 'invalid_request_error')
+            return
+
+        seed = hashlib.sha256(f'{config.seed}\0{prompt}'.encode()).hexdigest()
+        tokens = min(max_tokens, config.response_tokens)
+        names = BATCH_FUNCTION_RE.findall(prompt) if 'one line per function' in prompt else []
+        if names:
+            text = '\n'.join(f'{name}: {fake_summary(seed + name, tokens)}' for name in names)
+        else:
+            text = fake_summary(seed, tokens)
+        completion_tokens = count_tokens(text)
+        delay = config.latency + config.latency_per_token * completion_tokens
+        delay *= 1 + config.jitter * (2 * rng.random() - 1)
+        if rng.random() < config.slow_rate:
+            self.server.count('slow')
+            delay = max(delay, config.slow_latency)
+        time.sleep(max(0, delay))
+        self.server.count('prompt_tokens', prompt_tokens)
+        self.server.count('completion_tokens', completion_tokens)
+        self.server.count('completions')
+        self.send_json(200, {
+            'id': 'cmpl-' + seed[:24],
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), config=None, verbose=False):
+        super().__init__(address, MockHandler)
+        self.config = config or MockConfig()
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.request_times = collections.deque()
+        self.random = random.Random(self.config.seed)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def rng(self):
+        # Seeded per request from a shared generator so runs are repeatable
+        # (modulo thread scheduling)
+        with self.lock:
+            return random.Random(self.random.random())
+
+    def take_rate_limit(self):
+        # Sliding one-minute window; returns how long to wait if we're over
+        if not self.config.rpm:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            while self.request_times and self.request_times[0] <= now - 60:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.config.rpm:
+                return self.request_times[0] + 60 - now
+            self.request_times.append(now)
+        return None
+
+    def start(self):
+        # Serve from a background thread, for using the mock in-process
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for an OpenAI-compatible completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds per request')
+    parser.add_argument('--latency-per-token', type=float, default=0.01, help='Additional seconds per generated token')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Randomly vary latency by up to this fraction')
+    parser.add_argument('--rpm', type=int, default=None, help='Answer with 429s beyond this many requests per minute')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests to answer with a 429 anyway')
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help='Fraction of requests to answer with a 500')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='Fraction of requests that are stragglers, taking --slow-latency seconds')
+    parser.add_argument('--slow-latency', type=float, default=30.0)
+    parser.add_argument('--max-context', type=int, default=4097,
+                        help='Reject prompts longer than this (prompt + max_tokens, in rough tokens)')
+    parser.add_argument('--response-tokens', type=int, default=40, help='Length of each made-up summary')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+    config = MockConfig(latency=args.latency, latency_per_token=args.latency_per_token, jitter=args.jitter,
+                        rpm=args.rpm, error_rate=args.error_rate, server_error_rate=args.server_error_rate,
+                        max_context=args.max_context, response_tokens=args.response_tokens, seed=args.seed,
+                        slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    server = MockServer((args.host, args.port), config, verbose=args.verbose)
+    print(f'Serving mock completions API at {server.url}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
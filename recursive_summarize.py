@@ -2,11 +2,26 @@
 
 import sys
 import os
+import re
 import json
 import graphlib
+import concurrent.futures
+import heapq
+import collections
+import functools
+import itertools
+import threading
+import hashlib
+import time
 import openai
 import backoff
 import argparse
+from summary_cache import SummaryCache
+from callgraph_utils import strongly_connected_components, condense, is_cyclic, CompactCallGraph, file_signature
+from fingerprint import FingerprintStore, compute_fingerprints
+from decomp_store import DecompStore
+from llm_backend import make_backend, BACKENDS, DEFAULT_BASE_URL, RateLimitError, ContextLengthError, TransientError, DeadlineExceeded
+from tracing import Tracer, MetricsServer, trace_context, current_context
 # For syntax highlighting
 from pygments import highlight, lexers, formatters
 
@@ -15,105 +30,883 @@ if not 'OPENAI_API_KEY' in os.environ:
     openai.api_key_path = '/Users/moyix/codex_cve/openai.key'
 
 DEBUG = False
+# Where completions come from (see llm_backend.py); set from the command line,
+# or the openai package if nothing else was asked for
+BACKEND = None
+# Set from the command line; see RateLimiter below
+RATE_LIMITER = None
+# Persistent completion cache (a SummaryCache), also set from the command line
+CACHE = None
+# How to split up functions that are too big for one prompt: 'sequential'
+# (summarize_long_code) or 'mapreduce' (summarize_long_code_mapreduce)
+CHUNKING = 'sequential'
+FAN_IN = 4
+CHUNK_JOBS = 4
+# Number of times to go round each recursive cycle (see summarize_component)
+SCC_PASSES = 1
+# Batching of small functions into a single request (see summarize_batch);
+# a BATCH_SIZE of 1 turns it off
+BATCH_SIZE = 1
+BATCH_TOKENS = 2048
+# Token budget for the callee summaries at the top of each prompt (see
+# callee_context); None means no limit
+CALLEE_TOKENS = 1536
+# Cross-binary summary store keyed by function fingerprint (see fingerprint.py),
+# along with the fingerprints of the functions in this program
+FINGERPRINT_STORE = None
+FINGERPRINTS = None
+PROGRAM_NAME = None
+# Counts of API requests, tokens, and prompts that turned out to be too long
+# (each of which sends summarize_code on to its next strategy)
+STATS = collections.Counter()
+_stats_lock = threading.Lock()
+# Per-request tracing and profiling (see tracing.py), set from the command line
+TRACER = None
+# Seconds to wait for any one response (None: no limit), and
+# how often to retry timeouts and server errors before giving up. Waits between
+# retries are jittered, so workers that failed together don't retry together.
+REQUEST_TIMEOUT = 120
+MAX_RETRIES = 5
+RETRY_BASE_WAIT = 1
+RETRY_MAX_WAIT = 60
+# Hedging (see HedgedRequests); None turns it off
+HEDGER = None
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'gpt-wpre', 'completions.sqlite')
 
 def clean_decomp(decomp):
     return decomp.strip('\n') + '\n'
 
+# Loading extractor output. extract_ghidra_decomp.py writes either one big JSON
+# object, or with --jsonl one {name: value} object per line as it goes; either
+# way we end up with the same {name: value} mappings. Failed decompilations are
+# recorded as null.
+def load_json_or_jsonl(path):
+    if not path.endswith('.jsonl'):
+        with open(path) as f:
+            return json.load(f)
+    data = {}
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                data.update(json.loads(line))
+            except json.JSONDecodeError:
+                # A partial last line from an interrupted extraction is
+                # fine; a bad line with more after it is not
+                if f.read().strip():
+                    raise ValueError(f'{path}: malformed line {lineno}')
+                break
+    return data
+
+def resolve_input(progdir, filename):
+    # Fall back to the streaming variant if that's all the extractor left us
+    path = os.path.join(progdir, filename)
+    if not os.path.exists(path) and os.path.exists(path + 'l'):
+        return path + 'l'
+    return path
+
+def load_inputs(progdir, call_graph_file, decompilations_file):
+    # Function bodies are only read when we get to them; see decomp_store.py
+    decompilations = DecompStore(resolve_input(progdir, decompilations_file))
+    # The call graph is kept in compact form in a sidecar file next to the
+    # JSON (see CompactCallGraph), rebuilt whenever either input changes
+    call_graph_path = resolve_input(progdir, call_graph_file)
+    sidecar = call_graph_path + '.csr'
+    signature = [file_signature(call_graph_path), file_signature(decompilations.path)]
+    graph = CompactCallGraph.load(sidecar, signature)
+    if graph is None:
+        callgraph = load_json_or_jsonl(call_graph_path)
+        # Same pruning the JSON extractor does before saving: drop functions
+        # we have no code for, and calls to them
+        callgraph = {func: [callee for callee in callees if callee in decompilations]
+                     for func, callees in callgraph.items() if func in decompilations}
+        graph = CompactCallGraph.from_dict(callgraph)
+        graph.save(sidecar, signature)
+    return graph, decompilations
+
 # Misc graph util functions
-def transitive_deps(func, callgraph):
-    deps = set()
-    def dfs(func):
-        for callee in callgraph[func]:
-            if callee not in deps:
-                deps.add(callee)
-                dfs(callee)
-    dfs(func)
-    return deps
-
-def subgraph(callgraph, root):
-    subgraph = {}
-    subgraph[root] = callgraph[root]
-    for func in transitive_deps(root, callgraph):
-        subgraph[func] = callgraph[func]
-    return subgraph
+def critical_path_lengths(callgraph):
+    # Length of the longest chain of callers from each function up to a root
+    # (or up to the -f target, which is the only root of its subgraph). Once a
+    # function is summarized, this is how many more rounds of summarization
+    # stand between it and the end of the run.
+    # Members of a recursive cycle all get the same length.
+    components = strongly_connected_components(callgraph)
+    component_of, dag = condense(callgraph, components)
+    callers = callers_of(dag)
+    lengths = {}
+    # Components come out callees-first, so reversed visits callers first
+    for i in reversed(range(len(components))):
+        lengths[i] = max((lengths[caller] + 1 for caller in callers[i]), default=0)
+    return {func: lengths[component_of[func]] for func in callgraph}
+
+def callers_of(callgraph):
+    callers = {func: [] for func in callgraph}
+    for func, callees in callgraph.items():
+        for callee in callees:
+            callers[callee].append(func)
+    return callers
+
+def changed_functions(old_callgraph, old_decompilations, callgraph, decompilations):
+    # Functions that are new, whose code changed, or whose set of callees
+    # changed since the previous version of the program
+    changed = set()
+    for func in callgraph:
+        if func not in old_callgraph or func not in old_decompilations:
+            changed.add(func)
+        elif sorted(old_callgraph[func]) != sorted(callgraph[func]):
+            changed.add(func)
+        elif clean_decomp(old_decompilations[func]) != clean_decomp(decompilations[func]):
+            changed.add(func)
+    return changed
+
+def dirty_functions(changed, callgraph):
+    # A function's summary is built from its callees' summaries, so anything
+    # that (transitively) calls a changed function needs redoing too
+    callers = callers_of(callgraph)
+    dirty = set(changed)
+    stack = list(changed)
+    while stack:
+        func = stack.pop()
+        for caller in callers[func]:
+            if caller not in dirty:
+                dirty.add(caller)
+                stack.append(caller)
+    return dirty
 
 def print_call_tree(root, callgraph, depth=0):
     print('  '*depth + root)
     for callee in callgraph[root]:
         print_call_tree(callee, callgraph, depth+1)
 
+# Tokenizer used to size prompts locally. GPT-2's vocabulary is close enough to
+# text-davinci-003's that it's fine for budgeting (it slightly overcounts runs of
+# whitespace, which errs on the safe side).
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+def get_tokenizer():
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            # Suppress logging in transformers
+            os.environ['TRANSFORMERS_VERBOSITY'] = 'error'
+            from transformers import GPT2TokenizerFast
+            _tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+            _tokenizer.model_max_length = sys.maxsize
+    return _tokenizer
+
+def count_tokens(text):
+    return len(get_tokenizer().encode(text))
+
+# Token bucket enforcing requests-per-minute and tokens-per-minute budgets, so
+# that we stay under the API quota instead of finding it by getting 429s.
+# Callers reserve capacity up front and the buckets may go into debt; whoever
+# put them there sleeps until it's paid off. That keeps things roughly FIFO,
+# so a big prompt can't be starved forever by a stream of small ones.
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = requests_per_minute or 0
+        self.token_bucket = tokens_per_minute or 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.request_bucket = min(self.requests_per_minute,
+                                      self.request_bucket + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_bucket = min(self.tokens_per_minute,
+                                    self.token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens):
+        with self.lock:
+            self._refill()
+            wait = 0
+            if self.requests_per_minute:
+                self.request_bucket -= 1
+                if self.request_bucket < 0:
+                    wait = max(wait, -self.request_bucket * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # A single request bigger than the whole budget can still go
+                # through once the bucket is full, rather than never
+                self.token_bucket -= min(tokens, self.tokens_per_minute)
+                if self.token_bucket < 0:
+                    wait = max(wait, -self.token_bucket * 60 / self.tokens_per_minute)
+        if wait > 0:
+            if DEBUG: print(f"Rate limiter: waiting {wait:.1f}s")
+            time.sleep(wait)
+        return wait
+
 # Custom exception for prompt too long errors so that we can use the
 # same function for simulation and actual summarization
 class PromptTooLongError(Exception):
     pass
 
-@backoff.on_exception(backoff.expo, openai.error.RateLimitError)
-def summarize(text, max_tokens=256):
+# Generation parameters. These are all part of the cache key, so changing any
+# of them means cached completions won't be reused.
+MODEL = "text-davinci-003"
+TEMPERATURE = 0.7
+TOP_P = 1
+STOP = ["\n\n"]
+MODEL_MAX_TOKENS = 4096
+SHORT_SUMMARY_TOKENS = 256
+LONG_SUMMARY_TOKENS = 512
+# Slack for the difference between our tokenizer and the model's, and between
+# counting lines separately and counting them all at once
+PROMPT_SAFETY_MARGIN = 32
+
+def count_stats(**counts):
+    with _stats_lock:
+        STATS.update(counts)
+
+def get_backend():
+    global BACKEND
+    if BACKEND is None:
+        BACKEND = make_backend('openai', timeout=REQUEST_TIMEOUT)
+    return BACKEND
+
+# Sends a duplicate of any request that's taking unusually long and uses
+# whichever copy answers first. A few slow responses (an overloaded replica, a
+# stalled connection) would otherwise hold up everything that's waiting on
+# those functions; this way they only cost the duplicate's tokens. "Unusually
+# long" is a percentile of recent response times, which adapts to the model
+# and the load. Duplicates are capped at a fraction of all requests so that an
+# API that's slow across the board doesn't get twice the traffic.
+class HedgedRequests:
+    def __init__(self, percentile=95, max_fraction=0.1, min_samples=20, window=500, workers=8):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+        # Two threads per request that can be in flight: the original and its duplicate
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * workers)
+
+    def threshold(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * self.percentile // 100)]
+
+    def take_hedge(self):
+        with self.lock:
+            if self.hedges >= self.max_fraction * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, send, reserve, event):
+        # send() makes the request; reserve() waits for the rate limiter
+        # before sending a duplicate
+        with self.lock:
+            self.requests += 1
+        threshold = self.threshold()
+        if threshold is None:
+            return self.timed(send)
+        original = self.pool.submit(self.timed, send)
+        try:
+            return original.result(timeout=threshold)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self.take_hedge():
+            return original.result()
+        reserve()
+        count_stats(hedges=1)
+        event['hedges'] += 1
+        duplicate = self.pool.submit(self.timed, send)
+        pending = {original, duplicate}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser can't be called back, so it runs on and is ignored
+                    if future is duplicate:
+                        count_stats(hedge_wins=1)
+                        event['hedge_wins'] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def timed(self, send):
+        start = time.monotonic()
+        result = send()
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+def retry_wait(attempt):
+    # Exponential backoff with full jitter, capped at RETRY_MAX_WAIT
+    return backoff.full_jitter(min(RETRY_MAX_WAIT, RETRY_BASE_WAIT * 2 ** attempt))
+
+def create_completion(text, max_tokens, prompt_tokens, stop=STOP, event=None):
+    # event is the trace record for this request (see summarize), adding up
+    # over all the attempts
+    if event is None:
+        event = collections.Counter()
+    for attempt in itertools.count():
+        try:
+            completion = send_completion(text, max_tokens, prompt_tokens, stop, event)
+            break
+        except ContextLengthError as e:
+            count_stats(overflows=1)
+            event['overflow'] = True
+            raise PromptTooLongError(str(e))
+        except RateLimitError as e:
+            # Always worth waiting out, but no sooner than we were told to
+            count_stats(rate_limited=1)
+            error = e
+            wait = max(e.retry_after or 0, retry_wait(attempt))
+        except TransientError as e:
+            count_stats(transient_errors=1)
+            if isinstance(e, DeadlineExceeded):
+                count_stats(timeouts=1)
+            if attempt >= MAX_RETRIES:
+                raise
+            error = e
+            wait = retry_wait(attempt)
+        if DEBUG: print(f"Request failed ({type(error).__name__}: {error}); retrying in {wait:.1f}s")
+        time.sleep(wait)
+    completion = completion.strip()
+    completion_tokens = count_tokens(completion)
+    count_stats(completions=1, prompt_tokens=prompt_tokens, generated_tokens=completion_tokens)
+    event['prompt_tokens'] = prompt_tokens
+    event['completion_tokens'] = completion_tokens
+    return completion
+
+def send_completion(text, max_tokens, prompt_tokens, stop, event):
+    # One attempt at getting a completion, maybe sent twice (see HedgedRequests)
+    def reserve():
+        if RATE_LIMITER is not None:
+            # The API counts max_tokens against the token quota, not what we get back
+            event['queued'] += RATE_LIMITER.acquire(prompt_tokens + max_tokens)
+        count_stats(requests=1)
+    def send():
+        return get_backend().complete(MODEL, text, max_tokens, TEMPERATURE, TOP_P, stop)
+    reserve()
+    event['attempts'] += 1
+    start = time.monotonic()
+    try:
+        if HEDGER is None:
+            return send()
+        return HEDGER.call(send, reserve, event)
+    finally:
+        event['latency'] += time.monotonic() - start
+
+def summarize(text, max_tokens=SHORT_SUMMARY_TOKENS, stop=STOP, trace=None):
+    # trace adds to (or, in worker threads, stands in for) the trace_context
+    # fields that say what this request is for
+    if TRACER is None:
+        return _summarize(text, max_tokens, stop, None)
+    with TRACER.request(**{**current_context(), **(trace or {}), 'max_tokens': max_tokens}) as event:
+        return _summarize(text, max_tokens, stop, event)
+
+def _summarize(text, max_tokens, stop, event):
     if DEBUG:
         print("PROMPT:")
         print(text)
-    try:
-        completion = openai.Completion.create(
-            engine="text-davinci-003",
-            prompt=text,
-            temperature=0.7,
-            max_tokens=max_tokens,
-            top_p=1,
-            stop=["\n\n"]
-        )['choices'][0]['text'].strip()
-    except openai.error.InvalidRequestError as e:
-        if 'maximum context length' in str(e):
-            raise PromptTooLongError(str(e))
-        else:
-            raise e
+    key = None
+    if CACHE is not None:
+        params = dict(model=MODEL, prompt=text, temperature=TEMPERATURE,
+                      max_tokens=max_tokens, top_p=TOP_P, stop=stop)
+        # Keep answers from other servers (mock_server.py, self-hosted models
+        # with the same name) apart from OpenAI's. Left out for OpenAI itself
+        # so completions cached before there was a choice still match.
+        endpoint = get_backend().base_url
+        if endpoint != DEFAULT_BASE_URL:
+            params['endpoint'] = endpoint
+        key = CACHE.make_key(**params)
+        completion = CACHE.get(key)
+        if completion is not None:
+            if event is not None:
+                event['cache_hit'] = True
+            if DEBUG:
+                print("SUMMARY (cached):")
+                print(completion)
+            return completion
+    # Don't bother sending anything we already know is too long
+    prompt_tokens = count_tokens(text)
+    if prompt_tokens + max_tokens + PROMPT_SAFETY_MARGIN > MODEL_MAX_TOKENS:
+        count_stats(overflows=1)
+        if event is not None:
+            event['prompt_tokens'] = prompt_tokens
+            event['overflow'] = True
+        raise PromptTooLongError(f'Prompt too long: {prompt_tokens} + {max_tokens} > {MODEL_MAX_TOKENS}')
+    completion = create_completion(text, max_tokens, prompt_tokens, stop=stop, event=event)
+    if CACHE is not None:
+        CACHE.put(key, completion)
     if DEBUG:
         print("SUMMARY:")
         print(completion)
     return completion
 
-def summarize_short_code(decomp, summaries, callees):
-    prompt = ''
+# Stands in for the summary of a callee in the same recursive cycle that
+# hasn't been summarized yet
+RECURSION_PLACEHOLDER = '(not summarized yet; it is part of a recursive cycle with this function)'
+
+def callee_header(summaries, callees):
+    header = ''
     if len(callees) > 0:
-        prompt += 'Given the following summaries:\n'
+        header += 'Given the following summaries:\n'
         for callee in callees:
-            prompt += f'{callee}: {summaries[callee]}\n'
+            header += f'{callee}: {summaries.get(callee, RECURSION_PLACEHOLDER)}\n'
+    return header
+
+# Functions with lots of callees (dispatchers, big init routines) can't afford
+# a full line for every one of them, and the long-code strategies repeat the
+# header in every chunk prompt. When the header would go over CALLEE_TOKENS, the
+# callees the function refers to most often keep their own lines and the rest
+# are collapsed into groups of CALLEE_GROUP_SIZE, each described by one summary
+# of its members' summaries. Groups are formed in name order, so hub functions
+# that share a long tail of callees share the group summaries too (they're
+# memoized here, and go through the completion cache like everything else).
+# If even one line per group won't fit, groups get bigger and are summarized
+# hierarchically: a summary of the summaries of their subgroups.
+CALLEE_GROUP_SIZE = 8
+GROUP_SUMMARY_TOKENS = 64
+GROUP_INSTRUCTION = 'Describe what these functions do, taken together, in a single sentence:\n'
+# Upper bound on the ", ... and N more: " around a group's names and summary
+GROUP_LABEL_TOKENS = 10
+IDENTIFIER_RE = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]*\b')
+
+def rank_callees(decomp, callees):
+    # Most referenced first; ties keep the call graph's order
+    counts = collections.Counter(IDENTIFIER_RE.findall(decomp))
+    order = {callee: i for i, callee in enumerate(callees)}
+    return sorted(callees, key=lambda callee: (-counts[callee], order[callee]))
+
+def group_names(names):
+    if len(names) <= CALLEE_GROUP_SIZE:
+        return ', '.join(names)
+    return ', '.join(names[:CALLEE_GROUP_SIZE]) + f' and {len(names) - CALLEE_GROUP_SIZE} more'
+
+def split_group(items, group_size):
+    parts = -(-len(items) // group_size)
+    return [items[i*len(items)//parts:(i+1)*len(items)//parts] for i in range(parts)]
+
+@functools.lru_cache(maxsize=None)
+def summarize_group(items):
+    # items is a tuple of (name, summary) pairs, sorted by name
+    if len(items) > CALLEE_GROUP_SIZE:
+        lines = []
+        for part in split_group(items, -(-len(items) // CALLEE_GROUP_SIZE)):
+            summary = summarize_group(part)
+            if summary is None:
+                return None
+            lines.append(f'{group_names([name for name, _ in part])}: {summary}\n')
+    else:
+        lines = [f'{name}: {summary}\n' for name, summary in items]
+    prompt = 'Given the following summaries:\n' + ''.join(lines) + GROUP_INSTRUCTION
+    try:
+        return summarize(prompt, max_tokens=GROUP_SUMMARY_TOKENS, trace={'stage': 'group'})
+    except PromptTooLongError:
+        return None
+
+def plan_callee_context(line_tokens, name_tokens, budget):
+    # Given the token counts of the callees' lines in rank order and the
+    # largest token count of any of their names, how many to keep and how big
+    # to make the groups for the rest. Group lines are costed at their
+    # maximum size, so the result is guaranteed to fit.
+    n = len(line_tokens)
+    group_size = CALLEE_GROUP_SIZE
+    while True:
+        kept_tokens = sum(line_tokens)
+        for keep in range(n, -1, -1):
+            if keep < n:
+                kept_tokens -= line_tokens[keep]
+            groups = -(-(n - keep) // group_size)
+            listed = min(n - keep, groups * CALLEE_GROUP_SIZE)
+            group_tokens = groups * (GROUP_SUMMARY_TOKENS + GROUP_LABEL_TOKENS) + listed * name_tokens
+            if kept_tokens + group_tokens <= budget:
+                return keep, group_size
+        if group_size >= n:
+            # Everything in one group and it still doesn't fit; that's the
+            # best we can do
+            return 0, max(n, 1)
+        group_size *= CALLEE_GROUP_SIZE
+
+def callee_context(summaries, callees, decomp):
+    header = callee_header(summaries, callees)
+    if CALLEE_TOKENS is None or count_tokens(header) <= CALLEE_TOKENS:
+        return header
+    ranked = rank_callees(decomp, callees)
+    lines = {callee: f'{callee}: {summaries.get(callee, RECURSION_PLACEHOLDER)}\n' for callee in callees}
+    budget = CALLEE_TOKENS - static_tokens('Given the following summaries:\n')
+    keep, group_size = plan_callee_context([count_tokens(lines[callee]) for callee in ranked],
+                                           max(count_tokens(callee + ', ') for callee in callees), budget)
+    kept = set(ranked[:keep])
+    header = 'Given the following summaries:\n'
+    header += ''.join(lines[callee] for callee in callees if callee in kept)
+    rest = tuple(sorted((callee, summaries.get(callee, RECURSION_PLACEHOLDER)) for callee in ranked[keep:]))
+    for group in split_group(rest, group_size):
+        summary = summarize_group(group)
+        if summary is None:
+            # Couldn't summarize the group; fall back to its members' own lines
+            header += ''.join(f'{name}: {summary}\n' for name, summary in group)
+        else:
+            header += f'{group_names([name for name, _ in group])}: {summary}\n'
+    if DEBUG: print(f"Kept {keep} of {len(callees)} callee summaries, grouped the rest {group_size} at a time")
+    return header
+
+def summarize_short_code(decomp, summaries, callees):
+    prompt = callee_context(summaries, callees, decomp)
     prompt += 'Describe what this function does in a single sentence:\n'
     prompt += '```\n' + decomp + '\n```\n'
     one_line_summary = summarize(prompt)
     return one_line_summary
 
+CHUNK_CONTEXT_HEADER = 'And the following summaries of the code leading up to this snipppet:\n'
+CHUNK_INSTRUCTIONS = {
+    'long': 'Describe what this code does in a paragraph:\n',
+    'short': 'Describe what this code does in a single sentence:\n',
+}
+# max_tokens to use for each chunk summary. Every earlier chunk's summary goes
+# into the prompt for the next one, so for really big functions we have to
+# cap them below the usual limits to leave room for the code.
+CHUNK_SUMMARY_TOKENS = {
+    'long': (LONG_SUMMARY_TOKENS, 384, 256),
+    'short': (SHORT_SUMMARY_TOKENS, 128, 64),
+}
+COMBINE_HEADER = 'Given the following summaries of the code:\n'
+COMBINE_INSTRUCTION = 'Describe what the code does in a single sentence.\n'
+# Upper bound on the "Part i/n: " label and newline around each chunk summary
+PART_LABEL_TOKENS = 10
+
+# Token count for a single line of code (including its newline). Decompiled
+# code is full of repeated lines, so it's worth remembering these.
+_line_tokens = {}
+def count_line_tokens(line):
+    n = _line_tokens.get(line)
+    if n is None:
+        n = _line_tokens[line] = count_tokens(line + '\n')
+    return n
+
+def prime_line_tokens(lines):
+    # Fill in count_line_tokens for lots of lines at once, which is far faster
+    # than going one by one since the fast tokenizer batches them natively
+    todo = list({line for line in lines if line not in _line_tokens})
+    tokenizer = get_tokenizer()
+    for i in range(0, len(todo), 10000):
+        batch = todo[i:i+10000]
+        for line, ids in zip(batch, tokenizer([line + '\n' for line in batch])['input_ids']):
+            _line_tokens[line] = len(ids)
+
+def clip_tokens(text, max_tokens):
+    # Cut text down to max_tokens by our count. The model stops at its own
+    # max_tokens, but its tokenizer may not be ours, and plans that budget
+    # for summaries of at most that size have to be able to rely on it.
+    tokenizer = get_tokenizer()
+    ids = tokenizer.encode(text)
+    if len(ids) <= max_tokens:
+        return text
+    return tokenizer.decode(ids[:max_tokens]).strip()
+
+# Token counts of the fixed bits of text that go into every prompt
+@functools.lru_cache(maxsize=None)
+def static_tokens(text):
+    return count_tokens(text)
+
+def next_chunk(line_tokens, start, room, max_lines):
+    # Greedily take as many lines starting at `start` as fit in `room` tokens
+    end = start
+    used = 0
+    while end < len(line_tokens) and end - start < max_lines and used + line_tokens[end] <= room:
+        used += line_tokens[end]
+        end += 1
+    return end
+
+def plan_long_code(line_tokens, fixed_tokens, max_tokens, max_lines=100):
+    # Work out chunk boundaries for summarize_long_code before spending anything.
+    # fixed_tokens covers everything in a chunk prompt other than the code and
+    # the summaries of earlier chunks; those summaries aren't known yet, so we
+    # assume each one uses all of its max_tokens. Returns None if the function
+    # can't be summarized this way even in that worst case.
+    summary_tokens = max_tokens + PART_LABEL_TOKENS
+    budget = MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens
+    chunks = []
+    start = 0
+    while start < len(line_tokens):
+        room = budget - fixed_tokens - len(chunks) * summary_tokens
+        end = next_chunk(line_tokens, start, room, max_lines)
+        if end == start:
+            return None
+        chunks.append((start, end))
+        start = end
+    # ...and the prompt that combines all the chunk summaries has to fit too
+    combine_tokens = count_tokens(COMBINE_HEADER + COMBINE_INSTRUCTION) + len(chunks) * summary_tokens
+    if combine_tokens + SHORT_SUMMARY_TOKENS + PROMPT_SAFETY_MARGIN > MODEL_MAX_TOKENS:
+        return None
+    return chunks
+
 def summarize_long_code(decomp, summaries, callees, max_lines=100, strategy='long'):
+    if strategy not in CHUNK_INSTRUCTIONS:
+        raise ValueError('Invalid strategy')
     codelines = decomp.split('\n')
-    base_prompt = ''
-    if len(callees) > 0:
-        base_prompt += 'Given the following summaries:\n'
-        for callee in callees:
-            base_prompt += f'{callee}: {summaries[callee]}\n'
+    base_prompt = callee_context(summaries, callees, decomp)
+    instruction = CHUNK_INSTRUCTIONS[strategy]
+    line_tokens = [count_line_tokens(line) for line in codelines]
+    fixed_tokens = count_tokens(base_prompt + CHUNK_CONTEXT_HEADER + instruction + '```\n```\n')
+    # Check up front that the whole function can be done this way, so that we
+    # never spend calls on the first few chunks only to overflow on a later one
+    for max_tokens in CHUNK_SUMMARY_TOKENS[strategy]:
+        if plan_long_code(line_tokens, fixed_tokens, max_tokens, max_lines=max_lines) is not None:
+            break
+    else:
+        raise PromptTooLongError(f'Code does not fit in {MODEL_MAX_TOKENS} tokens with strategy {strategy}')
     chunk_summaries = []
-    for i in range(0, len(codelines), max_lines):
+    start = 0
+    while start < len(codelines):
         prompt = base_prompt
         if len(chunk_summaries) > 0:
-            prompt += 'And the following summaries of the code leading up to this snipppet:\n'
+            prompt += CHUNK_CONTEXT_HEADER
             for j,chunk_summary in enumerate(chunk_summaries):
                 prompt += f'Part {j+1}: {chunk_summary}\n'
-        if strategy == 'long':
-            prompt += 'Describe what this code does in a paragraph:\n'
-        elif strategy == 'short':
-            prompt += 'Describe what this code does in a single sentence:\n'
-        else:
-            raise ValueError('Invalid strategy')
-        prompt += '```\n' + '\n'.join(codelines[i:i+max_lines]) + '\n```\n'
-        chunk_summaries.append(
-            summarize(prompt, max_tokens=(512 if strategy == 'long' else 256))
-        )
+        prompt += instruction
+        # The real summaries are usually much shorter than the worst case the
+        # plan assumed, so fill whatever room is actually left. This never
+        # produces more chunks than the plan did.
+        room = (MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens
+                - count_tokens(prompt + '```\n```\n'))
+        end = next_chunk(line_tokens, start, room, max_lines)
+        if end == start:
+            # Can't happen as long as the summaries stay within the plan, but
+            # don't send a prompt with no code in it if it somehow does
+            raise PromptTooLongError(f'Code does not fit in {MODEL_MAX_TOKENS} tokens with strategy {strategy}')
+        prompt += '```\n' + '\n'.join(codelines[start:end]) + '\n```\n'
+        chunk_summary = summarize(prompt, max_tokens=max_tokens,
+                                  trace={'stage': 'chunk', 'chunk': len(chunk_summaries)})
+        # Hold each summary to the size the plan assumed, so the later chunks
+        # and the combining prompt are sure to fit
+        chunk_summaries.append(clip_tokens(chunk_summary, max_tokens))
+        start = end
     # Summarize the whole thing
-    prompt = 'Given the following summaries of the code:\n'
+    prompt = COMBINE_HEADER
     for i,chunk_summary in enumerate(chunk_summaries):
         prompt += f'Part {i+1}/{len(chunk_summaries)}: {chunk_summary}\n'
-    prompt += 'Describe what the code does in a single sentence.\n'
-    one_line_summary = summarize(prompt)
+    prompt += COMBINE_INSTRUCTION
+    one_line_summary = summarize(prompt, trace={'stage': 'combine'})
     return one_line_summary
 
+# Intermediate merges in the map-reduce strategy ask for a paragraph
+REDUCE_HEADER = 'Given the following summaries of consecutive parts of the code:\n'
+REDUCE_INSTRUCTION = 'Describe what this code does in a paragraph:\n'
+
+def reduce_fan_in(max_tokens, fan_in):
+    # Don't merge more summaries at once than are guaranteed to fit
+    reduce_room = MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens - static_tokens(REDUCE_HEADER + REDUCE_INSTRUCTION)
+    return max(2, min(fan_in, reduce_room // (max_tokens + PART_LABEL_TOKENS)))
+
+def summarize_long_code_mapreduce(decomp, summaries, callees, max_lines=100, strategy='long', fan_in=4, jobs=4):
+    # Alternative to summarize_long_code: chunk prompts don't include the
+    # summaries of earlier chunks, so all of them can be summarized at once,
+    # and the chunk summaries are then merged fan_in at a time until one is
+    # left. That takes O(log chunks) rounds of requests instead of O(chunks),
+    # and no prompt grows with the size of the function.
+    if strategy not in CHUNK_INSTRUCTIONS:
+        raise ValueError('Invalid strategy')
+    codelines = decomp.split('\n')
+    base_prompt = callee_context(summaries, callees, decomp)
+    instruction = CHUNK_INSTRUCTIONS[strategy]
+    max_tokens = CHUNK_SUMMARY_TOKENS[strategy][0]
+    line_tokens = [count_line_tokens(line) for line in codelines]
+    room = (MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens
+            - count_tokens(base_prompt + instruction + '```\n```\n'))
+    chunks = []
+    start = 0
+    while start < len(codelines):
+        end = next_chunk(line_tokens, start, room, max_lines)
+        if end == start:
+            raise PromptTooLongError(f'Code does not fit in {MODEL_MAX_TOKENS} tokens with strategy {strategy}')
+        chunks.append('\n'.join(codelines[start:end]))
+        start = end
+    fan_in = reduce_fan_in(max_tokens, fan_in)
+
+    # Trace context doesn't carry over into the pool's threads
+    context = current_context()
+    def summarize_part(prompt, i, stage):
+        # Clipped so that reduce_fan_in's sizing holds whatever the model's tokenizer
+        part = summarize(prompt, max_tokens=max_tokens, trace={**context, 'stage': stage, 'chunk': i})
+        return clip_tokens(part, max_tokens)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        prompts = [base_prompt + instruction + '```\n' + chunk + '\n```\n' for chunk in chunks]
+        parts = list(executor.map(summarize_part, prompts, range(len(prompts)), itertools.repeat('map')))
+        while len(parts) > fan_in:
+            prompts = []
+            for i in range(0, len(parts), fan_in):
+                group = parts[i:i+fan_in]
+                prompt = REDUCE_HEADER
+                for j,part in enumerate(group):
+                    prompt += f'Part {j+1}/{len(group)}: {part}\n'
+                prompt += REDUCE_INSTRUCTION
+                prompts.append(prompt)
+            parts = list(executor.map(summarize_part, prompts, range(len(prompts)), itertools.repeat('reduce')))
+    # Summarize the whole thing
+    prompt = COMBINE_HEADER
+    for i,part in enumerate(parts):
+        prompt += f'Part {i+1}/{len(parts)}: {part}\n'
+    prompt += COMBINE_INSTRUCTION
+    one_line_summary = summarize(prompt, trace={'stage': 'combine'})
+    return one_line_summary
+
+def summarize_function(func, callgraph, decompilations, summaries, max_lines=100):
+    # If an identical function (down to its whole call subtree) has been
+    # summarized before, in this binary or any other, just reuse that
+    if FINGERPRINT_STORE is not None:
+        summary = FINGERPRINT_STORE.get(FINGERPRINTS[func])
+        if summary is not None:
+            if DEBUG: print(f"Reusing summary of {func} from fingerprint store")
+            return summary
+    summary = summarize_code(func, callgraph, decompilations, summaries, max_lines=max_lines)
+    if FINGERPRINT_STORE is not None and summary is not None:
+        FINGERPRINT_STORE.put(FINGERPRINTS[func], summary, name=func, program=PROGRAM_NAME)
+    return summary
+
+def summarize_code(func, callgraph, decompilations, summaries, max_lines=100):
+    callees = callgraph[func]
+    decomp = clean_decomp(decompilations[func])
+    # Prompts are measured locally before anything is sent, so each of these
+    # attempts either fits or fails without making any API calls: first the
+    # whole function, then chunks summarized as paragraphs, then chunks
+    # summarized as sentences (which leaves room for more of them).
+    try:
+        with trace_context(function=func, strategy='whole'):
+            return summarize_short_code(decomp, summaries, callees)
+    except PromptTooLongError:
+        pass
+    for strategy, description in (('long', 'paragraphs'), ('short', 'sentences')):
+        try:
+            if DEBUG: print(f"Trying to summarize {func} in chunks of up to {max_lines} lines with {description}...")
+            with trace_context(function=func, strategy=f'{CHUNKING}-{strategy}'):
+                if CHUNKING == 'mapreduce':
+                    return summarize_long_code_mapreduce(decomp, summaries, callees, max_lines=max_lines,
+                                                         strategy=strategy, fan_in=FAN_IN, jobs=CHUNK_JOBS)
+                return summarize_long_code(decomp, summaries, callees, max_lines=max_lines, strategy=strategy)
+        except PromptTooLongError:
+            pass
+    return None
+
+BATCH_INSTRUCTION = ('Describe what each of the following functions does in a single sentence. '
+                     'Answer with exactly one line per function, in the form "<function name>: <summary>".\n')
+# Room to leave for each function's line of the answer
+BATCH_SUMMARY_TOKENS = 96
+
+def batch_item(func, callgraph, decompilations, summaries):
+    # The parts of a batched prompt that belong to one function: its callees'
+    # summary lines and its code
+    header = [f'{callee}: {summaries[callee]}\n' for callee in callgraph[func]]
+    code = f'Function {func}:\n```\n' + clean_decomp(decompilations[func]) + '```\n'
+    return header, code
+
+def batch_item_tokens(func, callgraph, decompilations, summaries):
+    # Size of a function's share of a batched prompt, or None if it's too big
+    # to be worth batching
+    header, code = batch_item(func, callgraph, decompilations, summaries)
+    tokens = count_tokens(''.join(header) + code) + BATCH_SUMMARY_TOKENS
+    return tokens if tokens <= BATCH_TOKENS // 2 else None
+
+def parse_batch_response(completion, funcs):
+    results = {}
+    for line in completion.splitlines():
+        m = re.match(r'^\s*(?:[-*]\s*|\d+[.)]\s*)?`?([A-Za-z_][\w.]*)`?\s*:\s*(.+?)\s*$', line)
+        if m and m.group(1) in funcs and m.group(1) not in results:
+            results[m.group(1)] = m.group(2)
+    return results
+
+def summarize_batch(funcs, callgraph, decompilations, summaries, max_lines=100):
+    # Summarize several small, independent functions with a single request,
+    # which saves both round trips and the instructions repeated in every
+    # prompt. Returns {func: summary} like summarize_component. Anything the
+    # model leaves out of its answer (or that we can't parse) is redone on
+    # its own.
+    results = {}
+    if FINGERPRINT_STORE is not None:
+        for func in funcs:
+            summary = FINGERPRINT_STORE.get(FINGERPRINTS[func])
+            if summary is not None:
+                results[func] = summary
+        funcs = [func for func in funcs if func not in results]
+    if len(funcs) > 1:
+        header = []
+        code = ''
+        for func in funcs:
+            item_header, item_code = batch_item(func, callgraph, decompilations, summaries)
+            header += [line for line in item_header if line not in header]
+            code += item_code
+        prompt = ''
+        if header:
+            prompt += 'Given the following summaries:\n' + ''.join(header)
+        prompt += BATCH_INSTRUCTION + code
+        try:
+            completion = summarize(prompt, max_tokens=BATCH_SUMMARY_TOKENS * len(funcs), stop=None,
+                                   trace={'function': funcs, 'strategy': 'batch'})
+            batch_results = parse_batch_response(completion, set(funcs))
+        except PromptTooLongError:
+            batch_results = {}
+        if DEBUG and len(batch_results) < len(funcs):
+            print(f"Batch answered {len(batch_results)}/{len(funcs)} functions; doing the rest one at a time")
+        for func, summary in batch_results.items():
+            results[func] = summary
+            if FINGERPRINT_STORE is not None:
+                FINGERPRINT_STORE.put(FINGERPRINTS[func], summary, name=func, program=PROGRAM_NAME)
+    for func in funcs:
+        if func not in results:
+            summary = summarize_function(func, callgraph, decompilations, summaries, max_lines=max_lines)
+            if summary is None:
+                return None
+            results[func] = summary
+    return results
+
+def summarize_component(component, callgraph, decompilations, summaries, max_lines=100):
+    # Summarize one strongly connected component of the call graph, returning
+    # {func: summary} for each member that wasn't already summarized, or None
+    # if any of them couldn't be summarized.
+    if not is_cyclic(component, callgraph):
+        func = component[0]
+        summary = summarize_function(func, callgraph, decompilations, summaries, max_lines=max_lines)
+        return None if summary is None else { func: summary }
+
+    # Members of a recursive cycle can't wait for each other, so we go round
+    # the cycle summarizing them in turn; callees in the cycle that haven't
+    # been done yet show up with RECURSION_PLACEHOLDER instead. Each further
+    # pass redoes every member using the others' summaries from the last one.
+    todo = [func for func in component if func not in summaries]
+    results = {}
+    if FINGERPRINT_STORE is not None:
+        for func in todo:
+            summary = FINGERPRINT_STORE.get(FINGERPRINTS[func])
+            if summary is None:
+                break
+            results[func] = summary
+        else:
+            return results
+        results = {}
+    for _ in range(SCC_PASSES):
+        for func in todo:
+            summary = summarize_code(func, callgraph, decompilations, collections.ChainMap(results, summaries), max_lines=max_lines)
+            if summary is None:
+                return None
+            results[func] = summary
+    if FINGERPRINT_STORE is not None:
+        # Only store the final pass, or later runs would reuse the first one
+        for func, summary in results.items():
+            FINGERPRINT_STORE.put(FINGERPRINTS[func], summary, name=func, program=PROGRAM_NAME)
+    return results
+
+def summary_order(callgraph):
+    # Like a topological sort, but members of each recursive cycle come out
+    # next to each other instead of raising CycleError
+    return [func for component in strongly_connected_components(callgraph) for func in component]
+
 def summarize_all(topo_order, callgraph, decompilations, max_lines=100, already_summarized=None):
     if already_summarized is None:
         summaries = {}
@@ -121,92 +914,337 @@ def summarize_all(topo_order, callgraph, decompilations, max_lines=100, already_
         # Make a copy so we don't modify the original
         summaries = already_summarized.copy()
 
+    components = strongly_connected_components(callgraph)
+    component_of, _ = condense(callgraph, components)
     for func in topo_order:
         if func in summaries:
             continue
-        callees = callgraph[func]
-        decomp = clean_decomp(decompilations[func])
-        # First try to summarize the whole function
-        summary = None
-        try:
-            summary = summarize_short_code(decomp, summaries, callees)
-        except PromptTooLongError:
-            pass
-        # If that fails, try to summarize the function in chunks of max_lines lines,
-        # decreasing max_lines until we find a chunk size that works or num_lines gets
-        # too small. We try to summarize in paragraphs first, then sentences.
-        num_lines = max_lines
-        while summary is None:
-            try:
-                if DEBUG: print(f"Trying to summarize {func} in chunks of {num_lines} lines with paragraphs...")
-                summary = summarize_long_code(decomp, summaries, callees, max_lines=num_lines, strategy='long')
-            except PromptTooLongError:
-                num_lines -= 10
-                if num_lines < 10:
-                    break
-        num_lines = max_lines
-        while summary is None:
-            try:
-                if DEBUG: print(f"Trying to summarize {func} in chunks of {num_lines} lines with sentences...")
-                summary = summarize_long_code(decomp, summaries, callees, max_lines=num_lines, strategy='short')
-            except PromptTooLongError:
-                num_lines -= 10
-                if num_lines < 10:
-                    break
-        if summary is None:
+        results = summarize_component(components[component_of[func]], callgraph, decompilations, summaries, max_lines=max_lines)
+        if results is None:
             break
-        summaries[func] = summary
-        yield { func: summary }
+        for func, summary in results.items():
+            summaries[func] = summary
+            yield { func: summary }
+
+def summarize_all_concurrent(callgraph, decompilations, max_lines=100, already_summarized=None, jobs=4):
+    if already_summarized is None:
+        summaries = {}
+    else:
+        # Make a copy so we don't modify the original
+        summaries = already_summarized.copy()
+
+    # Every function whose callees have all been summarized is ready to go, so
+    # instead of walking a static order we keep up to `jobs` of them in flight
+    # and let the sorter tell us what becomes ready as each one finishes. Wall
+    # clock time then scales with the depth of the call graph rather than the
+    # number of functions in it. Recursive cycles are collapsed first, so the
+    # sorter works on strongly connected components rather than functions.
+    #
+    # When there are more ready functions than free workers (or the rate
+    # limiter is holding things up), start the ones furthest from the root
+    # first so that the critical path isn't stuck behind a pile of cheap leaves.
+    priority = critical_path_lengths(callgraph)
+    components = strongly_connected_components(callgraph)
+    _, dag = condense(callgraph, components)
+    sorter = graphlib.TopologicalSorter(dag)
+    sorter.prepare()
+    ready = []
+    ready_at = {}
+    in_flight = {}
+    failed = False
+
+    # With batching on, small functions that are ready at the same time get
+    # packed into one request (up to BATCH_SIZE functions and BATCH_TOKENS
+    # tokens). We only look a little way down the ready queue for them so
+    # that batching can't reorder things much.
+    item_tokens = {}
+    def take_batch(first):
+        def tokens(i):
+            if i not in item_tokens:
+                component = components[i]
+                if is_cyclic(component, callgraph):
+                    item_tokens[i] = None
+                else:
+                    item_tokens[i] = batch_item_tokens(component[0], callgraph, decompilations, summaries)
+            return item_tokens[i]
+        if tokens(first) is None:
+            return [first]
+        batch = [first]
+        total = tokens(first)
+        skipped = []
+        for _ in range(4 * BATCH_SIZE):
+            if not ready or len(batch) >= BATCH_SIZE:
+                break
+            entry = heapq.heappop(ready)
+            t = tokens(entry[1])
+            if t is not None and total + t <= BATCH_TOKENS:
+                batch.append(entry[1])
+                total += t
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(ready, entry)
+        return batch
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for i in sorter.get_ready():
+                if all(func in summaries for func in components[i]):
+                    # Resuming: nothing to do, but its callers may now be ready
+                    sorter.done(i)
+                else:
+                    heapq.heappush(ready, (-priority[components[i][0]], i))
+                    ready_at[i] = time.monotonic()
+            while ready and len(in_flight) < jobs and not failed:
+                _, i = heapq.heappop(ready)
+                batch = take_batch(i) if BATCH_SIZE > 1 else [i]
+                if TRACER is not None:
+                    now = time.monotonic()
+                    for j in batch:
+                        TRACER.scheduled(components[j], now - ready_at.pop(j))
+                # Workers only read summaries of callees, which are complete by
+                # the time a function becomes ready, so sharing the dict is safe.
+                if len(batch) > 1:
+                    funcs = [components[j][0] for j in batch]
+                    future = executor.submit(summarize_batch, funcs, callgraph, decompilations, summaries, max_lines)
+                else:
+                    future = executor.submit(summarize_component, components[i], callgraph, decompilations, summaries, max_lines)
+                in_flight[future] = batch
+            if not in_flight:
+                if failed or not sorter.is_active():
+                    break
+                # Only resumed functions were marked done; go pick up their callers
+                continue
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                results = future.result()
+                if results is None:
+                    # Same as the serial version: stop scheduling new work, but
+                    # let anything already in flight finish and be written out.
+                    failed = True
+                    continue
+                for func, summary in results.items():
+                    summaries[func] = summary
+                    yield { func: summary }
+                sorter.done(*batch)
 
 # Note: using Dec 2022 OpenAI pricing for davinci: $0.0200  / 1K tokens
 TOKEN_PRICE_PER_K_CENTS = 2
-MODEL_MAX_TOKENS = 4096
 DUMMY_SHORT_SUMMARY = 'This function checks a value in a given location and, if it meets a certain condition, calls a warning function; otherwise, it calls an error function.'
 DUMMY_LONG_SUMMARY = 'This code is responsible for validating and initializing an inflate stream. It checks if a given parameter is greater than a limit and calls a warning or error function depending on the result, allocates a block of memory of size param_2 and returns a pointer to it, sets the bits of a uint stored at a different memory address based on the value of a ushort at a specific memory address, checks if a given value is a known sRGB profile and calls a warning or error function depending on the value and parameters, and if valid, sets up the third parameter with a certain value, checks if a read function is valid and computes a CRC32 value for a given input if the parameter is not NULL before producing an error, and reads a specified memory location, checks if a window size is valid, calls a read function, computes a CRC32 value, and stores an error message corresponding to the given parameter.'
-def estimate_usage(callgraph, decompilations, max_lines=100):
-    # Suppress logging in transformers
-    os.environ['TRANSFORMERS_VERBOSITY'] = 'error'
-    from transformers import GPT2TokenizerFast
-    tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
-    tokenizer.model_max_length = sys.maxsize
-
-    # Override summarize() to just count API calls
-    global summarize
+# Simple latency model for estimating wall-clock time: a fixed cost per
+# request plus a cost per generated token
+LATENCY_PER_CALL = 1.0
+LATENCY_PER_TOKEN = 0.02
+
+# The dry-run estimator below mirrors the decisions summarize_function makes,
+# but works purely with token counts: every distinct line of code and every
+# callee summary line is tokenized once (in bulk), and prompt sizes are sums
+# of those counts rather than re-tokenized prompts. Summaries are assumed to be
+# the size of the DUMMY_*_SUMMARY above.
+
+def dummy_summary_tokens(max_tokens):
+    if max_tokens >= LONG_SUMMARY_TOKENS:
+        return static_tokens(DUMMY_LONG_SUMMARY)
+    elif max_tokens >= SHORT_SUMMARY_TOKENS:
+        return static_tokens(DUMMY_SHORT_SUMMARY)
+    else:
+        return max_tokens
+
+def dummy_part_tokens(max_tokens):
+    # A "Part i/n: <summary>" line
+    return static_tokens('Part 1/1: \n') + dummy_summary_tokens(max_tokens)
+
+def estimate_long_code(line_tokens, header_tokens, strategy, max_lines=100):
+    # Requests made by summarize_long_code (or the map-reduce version), as a
+    # list of rounds, each a list of (prompt tokens, generated tokens) that
+    # can go out at the same time. None if the strategy doesn't fit.
+    instruction = CHUNK_INSTRUCTIONS[strategy]
+    fences = static_tokens('```\n```\n')
+    rounds = []
+    if CHUNKING == 'mapreduce':
+        max_tokens = CHUNK_SUMMARY_TOKENS[strategy][0]
+        generated = dummy_summary_tokens(max_tokens)
+        prefix = header_tokens + static_tokens(instruction) + fences
+        room = MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens - prefix
+        chunks = []
+        start = 0
+        while start < len(line_tokens):
+            end = next_chunk(line_tokens, start, room, max_lines)
+            if end == start:
+                return None
+            chunks.append([(prefix + sum(line_tokens[start:end]), generated)])
+            start = end
+        rounds.append([call for chunk in chunks for call in chunk])
+        fan_in = reduce_fan_in(max_tokens, FAN_IN)
+        parts = len(chunks)
+        while parts > fan_in:
+            reduce_round = []
+            for i in range(0, parts, fan_in):
+                group = min(fan_in, parts - i)
+                reduce_round.append((static_tokens(REDUCE_HEADER + REDUCE_INSTRUCTION) + group * dummy_part_tokens(max_tokens), generated))
+            rounds.append(reduce_round)
+            parts = len(reduce_round)
+    else:
+        fixed_tokens = header_tokens + static_tokens(CHUNK_CONTEXT_HEADER + instruction) + fences
+        for max_tokens in CHUNK_SUMMARY_TOKENS[strategy]:
+            if plan_long_code(line_tokens, fixed_tokens, max_tokens, max_lines=max_lines) is not None:
+                break
+        else:
+            return None
+        generated = dummy_summary_tokens(max_tokens)
+        start = 0
+        while start < len(line_tokens):
+            prefix = header_tokens + static_tokens(instruction) + fences
+            if rounds:
+                prefix += static_tokens(CHUNK_CONTEXT_HEADER) + len(rounds) * dummy_part_tokens(max_tokens)
+            end = next_chunk(line_tokens, start, MODEL_MAX_TOKENS - PROMPT_SAFETY_MARGIN - max_tokens - prefix, max_lines)
+            rounds.append([(prefix + sum(line_tokens[start:end]), generated)])
+            start = end
+        parts = len(rounds)
+    combine_tokens = static_tokens(COMBINE_HEADER + COMBINE_INSTRUCTION) + parts * dummy_part_tokens(max_tokens)
+    rounds.append([(combine_tokens, dummy_summary_tokens(SHORT_SUMMARY_TOKENS))])
+    return rounds
+
+def estimate_group_calls(size):
+    # Requests made by summarize_group for a group of this many callees
+    prompt = static_tokens('Given the following summaries:\n' + GROUP_INSTRUCTION)
+    if size <= CALLEE_GROUP_SIZE:
+        line = static_tokens(f'FUN_00000000: {DUMMY_SHORT_SUMMARY}\n')
+        return [(prompt + size * line, GROUP_SUMMARY_TOKENS)]
+    calls = []
+    parts = split_group(range(size), -(-size // CALLEE_GROUP_SIZE))
+    for part in parts:
+        calls.extend(estimate_group_calls(len(part)))
+    line = CALLEE_GROUP_SIZE * static_tokens('FUN_00000000, ') + GROUP_SUMMARY_TOKENS + GROUP_LABEL_TOKENS
+    calls.append((prompt + len(parts) * line, GROUP_SUMMARY_TOKENS))
+    return calls
+
+def estimate_callee_context(decomp, callees):
+    # Size of the callee header callee_context would build, and the group
+    # summary requests it would make along the way
+    if len(callees) == 0:
+        return 0, []
+    lines = {callee: count_line_tokens(f'{callee}: {DUMMY_SHORT_SUMMARY}') for callee in callees}
+    header_tokens = static_tokens('Given the following summaries:\n')
+    if CALLEE_TOKENS is None or header_tokens + sum(lines.values()) <= CALLEE_TOKENS:
+        return header_tokens + sum(lines.values()), []
+    ranked = rank_callees(decomp, callees)
+    name_tokens = max(count_tokens(callee + ', ') for callee in callees)
+    keep, group_size = plan_callee_context([lines[callee] for callee in ranked], name_tokens,
+                                           CALLEE_TOKENS - header_tokens)
+    header_tokens += sum(lines[callee] for callee in ranked[:keep])
+    calls = []
+    for group in split_group(ranked[keep:], group_size):
+        header_tokens += GROUP_SUMMARY_TOKENS + GROUP_LABEL_TOKENS + min(len(group), CALLEE_GROUP_SIZE) * name_tokens
+        calls.extend(estimate_group_calls(len(group)))
+    return header_tokens, calls
+
+def estimate_function(func, callgraph, decompilations, max_lines=100):
+    # Same as estimate_long_code, for the whole of summarize_function
+    callees = callgraph[func]
+    decomp = clean_decomp(decompilations[func])
+    header_tokens, group_calls = estimate_callee_context(decomp, callees)
+    line_tokens = [count_line_tokens(line) for line in decomp.split('\n')]
+    prompt_tokens = (header_tokens + static_tokens('Describe what this function does in a single sentence:\n')
+                     + static_tokens('```\n```\n') + sum(line_tokens))
+    # Group summaries have to be done before anything else (and sharing them
+    # between functions isn't accounted for)
+    rounds = [group_calls] if group_calls else []
+    if prompt_tokens + SHORT_SUMMARY_TOKENS + PROMPT_SAFETY_MARGIN <= MODEL_MAX_TOKENS:
+        return rounds + [[(prompt_tokens, dummy_summary_tokens(SHORT_SUMMARY_TOKENS))]]
+    for strategy in ('long', 'short'):
+        long_rounds = estimate_long_code(line_tokens, header_tokens, strategy, max_lines=max_lines)
+        if long_rounds is not None:
+            return rounds + long_rounds
+    return None
+
+def simulate_schedule(callgraph, durations, jobs=1):
+    # Replay the concurrent scheduler (same priorities, `jobs` workers) with
+    # each function taking durations[func] seconds. Returns the total time and
+    # the critical path as (seconds, number of functions).
+    components = strongly_connected_components(callgraph)
+    component_of, dag = condense(callgraph, components)
+    cost = [sum(durations.get(func, 0) for func in component) for component in components]
+    # Critical path: components come out callees-first
+    path_seconds = [0] * len(components)
+    path_functions = [0] * len(components)
+    for i in range(len(components)):
+        longest = max(dag[i], key=lambda j: path_seconds[j], default=None)
+        path_seconds[i] = cost[i] + (path_seconds[longest] if longest is not None else 0)
+        path_functions[i] = len(components[i]) + (path_functions[longest] if longest is not None else 0)
+    critical = max(range(len(components)), key=lambda i: path_seconds[i], default=None)
+    critical_path = (path_seconds[critical], path_functions[critical]) if critical is not None else (0, 0)
+
+    priority = critical_path_lengths(callgraph)
+    callers = callers_of(dag)
+    waiting = {i: len(dag[i]) for i in dag}
+    ready = [(-priority[components[i][0]], i) for i in dag if waiting[i] == 0]
+    heapq.heapify(ready)
+    running = []
+    now = 0
+    while ready or running:
+        while ready and len(running) < jobs:
+            _, i = heapq.heappop(ready)
+            heapq.heappush(running, (now + cost[i], i))
+        now, i = heapq.heappop(running)
+        for caller in callers[i]:
+            waiting[caller] -= 1
+            if waiting[caller] == 0:
+                heapq.heappush(ready, (-priority[components[caller][0]], caller))
+    return now, critical_path
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}h{seconds // 60 % 60:02d}m{seconds % 60:02d}s'
+
+def estimate_usage(callgraph, decompilations, max_lines=100, already_summarized=None, jobs=1):
+    if already_summarized is None:
+        already_summarized = {}
+    topo_order = summary_order(callgraph)
+    todo = [func for func in topo_order if func not in already_summarized]
+
+    # Tokenize everything we're going to need in bulk up front
+    prime_line_tokens(line for func in todo for line in clean_decomp(decompilations[func]).split('\n'))
+    prime_line_tokens(f'{callee}: {DUMMY_SHORT_SUMMARY}' for func in todo for callee in callgraph[func])
+
+    components = strongly_connected_components(callgraph)
+    cyclic = {func for component in components if is_cyclic(component, callgraph) for func in component}
     num_api_calls = 0
     num_prompt_tokens = 0
     num_generated_tokens = 0
-    def dummy_summarize(prompt, max_tokens=256):
-        nonlocal num_api_calls, num_prompt_tokens, num_generated_tokens
-        num_api_calls += 1
-        prompt_tokens = len(tokenizer.encode(prompt))
-        if prompt_tokens + max_tokens > MODEL_MAX_TOKENS:
-            raise PromptTooLongError(f'Prompt too long: {prompt_tokens} + {max_tokens} > {MODEL_MAX_TOKENS}')
-        num_prompt_tokens += prompt_tokens
-        if max_tokens == 256:
-            num_generated_tokens += len(tokenizer.encode(DUMMY_SHORT_SUMMARY))
-            return DUMMY_SHORT_SUMMARY
-        elif max_tokens == 512:
-            num_generated_tokens += len(tokenizer.encode(DUMMY_LONG_SUMMARY))
-            return DUMMY_LONG_SUMMARY
-        else:
-            num_generated_tokens += max_tokens
-            return 'x' * max_tokens
-    summarize = dummy_summarize
-    topo_order = list(graphlib.TopologicalSorter(callgraph).static_order())
-
-    # Estimate usage
-    summaries = {}
-    for summary in summarize_all(topo_order, callgraph, decompilations, max_lines=max_lines):
-        summaries.update(summary)
+    durations = {}
+    failed = []
+    for func in todo:
+        rounds = estimate_function(func, callgraph, decompilations, max_lines=max_lines)
+        if rounds is None:
+            failed.append(func)
+            continue
+        passes = SCC_PASSES if func in cyclic else 1
+        for calls in rounds:
+            num_api_calls += passes * len(calls)
+            num_prompt_tokens += passes * sum(prompt for prompt, _ in calls)
+            num_generated_tokens += passes * sum(generated for _, generated in calls)
+        durations[func] = passes * sum(max(LATENCY_PER_CALL + LATENCY_PER_TOKEN * generated for _, generated in calls)
+                                       for calls in rounds)
+    wall_clock, (critical_seconds, critical_functions) = simulate_schedule(callgraph, durations, jobs=jobs)
+    if RATE_LIMITER is not None:
+        # Can't go any faster than the quota allows
+        if RATE_LIMITER.requests_per_minute:
+            wall_clock = max(wall_clock, num_api_calls * 60 / RATE_LIMITER.requests_per_minute)
+        if RATE_LIMITER.tokens_per_minute:
+            # The quota counts max_tokens rather than what's generated; this is a lower bound
+            wall_clock = max(wall_clock, (num_prompt_tokens + num_generated_tokens) * 60 / RATE_LIMITER.tokens_per_minute)
 
-    if len(topo_order) != len(summaries):
-        print(f"Note: simulation failed after summarizing {len(summaries)}/{len(topo_order)} functions.")
-        failed_func = topo_order[len(summaries)]
+    if failed:
+        failed_func = failed[0]
         decomp_loc = clean_decomp(decompilations[failed_func]).count('\n') + 1
-        print(f"Failed function: {failed_func} with {len(callgraph[failed_func])} callees and {decomp_loc} LoC")
-        print("Estimates will reflect only the functions that were summarized.")
+        print(f"Note: {len(failed)}/{len(todo)} functions are too big to summarize, and the run will stop at the first of them.")
+        print(f"For example: {failed_func} with {len(callgraph[failed_func])} callees and {decomp_loc} LoC")
+        print("Estimates will reflect only the functions that can be summarized.")
     print("===== API usage estimates =====")
-    print(f"Number of functions: {len(summaries)}")
+    print(f"Number of functions: {len(todo) - len(failed)}")
     print(f"Estimated API calls: {num_api_calls}")
     print(f"Estimated prompt tokens: {num_prompt_tokens}")
     print(f"Estimated generated tokens: {num_generated_tokens}")
@@ -214,36 +1252,183 @@ def estimate_usage(callgraph, decompilations, max_lines=100):
     cost_in_cents = total_usage * TOKEN_PRICE_PER_K_CENTS / 1000
     cost_in_dollars = cost_in_cents / 100
     print(f"Estimated cost: ${cost_in_dollars:.2f}")
+    print(f"Estimated time with {jobs} job(s): {format_duration(wall_clock)}")
+    print(f"Critical path: {critical_functions} functions, {format_duration(critical_seconds)}")
+
+def target_functions(graph, functions, functions_file, function_regex, error):
+    # Everything given with -f, --functions-file and --function-regex, in
+    # order and without duplicates
+    roots = []
+    for arg in functions or []:
+        roots.extend(name for name in arg.split(',') if name)
+    if functions_file is not None:
+        with open(functions_file) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    roots.append(line)
+    missing = [root for root in roots if root not in graph]
+    if missing:
+        error(f'not in the call graph: {", ".join(missing[:10])}' + (' ...' if len(missing) > 10 else ''))
+    if function_regex is not None:
+        regex = re.compile(function_regex)
+        matches = [name for name in graph.names if regex.search(name)]
+        if not matches:
+            error(f'no functions match {function_regex!r}')
+        roots.extend(matches)
+    return list(dict.fromkeys(roots))
+
+def write_root_report(path, roots, graph, summaries):
+    reachable = {root: set(graph.reachable([root])) for root in roots}
+    reached_by = collections.Counter(i for funcs in reachable.values() for i in funcs)
+    report = {}
+    for root in roots:
+        report[root] = {
+            'summary': summaries.get(root),
+            'functions': len(reachable[root]),
+            # Functions in this root's call graph that other roots also need
+            'shared': sum(1 for i in reachable[root] if reached_by[i] > 1),
+        }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+def print_graph_stats(graph, top=10):
+    fan_in = graph.fan_in()
+    fan_out = graph.fan_out()
+    descendants = graph.descendant_counts()
+    # Computing descendants is the slow part, so keep them for next time
+    if graph.sidecar is not None:
+        graph.save(*graph.sidecar)
+    components = graph.components()
+    cycles = [c for c in components if len(c) > 1 or c[0] in graph.callees(c[0])]
+    print(f'{len(graph)} functions, {graph.num_edges()} calls, {len(cycles)} recursive cycles')
+    print(f'{sum(1 for n in fan_in if n == 0)} roots, {sum(1 for n in fan_out if n == 0)} leaves')
+    for title, counts in (('Most called', fan_in), ('Most callees', fan_out), ('Most descendants', descendants)):
+        print(f'{title}:')
+        for i in heapq.nlargest(top, range(len(graph)), key=counts.__getitem__):
+            print(f'  {graph.names[i]}: {counts[i]}')
 
 def main():
+    global DEBUG, RATE_LIMITER, CACHE, CHUNKING, FAN_IN, CHUNK_JOBS, SCC_PASSES, BATCH_SIZE, BATCH_TOKENS
+    global FINGERPRINT_STORE, FINGERPRINTS, PROGRAM_NAME, LATENCY_PER_CALL, LATENCY_PER_TOKEN, CALLEE_TOKENS
+    global BACKEND, MODEL, TRACER, REQUEST_TIMEOUT, MAX_RETRIES, RETRY_MAX_WAIT, HEDGER
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--function', required=False, default=None, help='Summarize only this function (and dependencies)')
+    parser.add_argument('-f', '--function', required=False, default=None, action='append',
+                        help='Summarize only this function (and dependencies); repeat or separate with commas for several')
+    parser.add_argument('--functions-file', default=None,
+                        help='Summarize only the functions listed in this file, one per line (and dependencies)')
+    parser.add_argument('--function-regex', default=None,
+                        help='Summarize only functions whose names match this regex (and dependencies)')
     parser.add_argument('-d', '--decompilations', required=False, default='decompilations.json')
     parser.add_argument('-g', '--call-graph', required=False, default='call_graph.json')
     parser.add_argument('-o', '--output', required=False, help='Output file (default: progdir/summaries.jsonl)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
     parser.add_argument('-n', '--dry-run', action='store_true', help="Don't actually call OpenAI, just estimate usage")
     parser.add_argument('-l', '--max-lines', type=int, default=100, help='Maximum number of lines to summarize at a time')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of functions to summarize concurrently')
+    parser.add_argument('--latency', type=float, default=LATENCY_PER_CALL,
+                        help='Seconds per API request assumed by --dry-run when estimating time')
+    parser.add_argument('--latency-per-token', type=float, default=LATENCY_PER_TOKEN,
+                        help='Additional seconds per generated token assumed by --dry-run')
+    parser.add_argument('--chunking', choices=['sequential', 'mapreduce'], default='sequential',
+                        help='How to summarize functions too big for one prompt: chunk by chunk, or all chunks at once then merge')
+    parser.add_argument('--fan-in', type=int, default=4, help='Number of chunk summaries merged per request with --chunking mapreduce')
+    parser.add_argument('--scc-passes', type=int, default=1,
+                        help='Number of passes over each set of mutually recursive functions')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Summarize up to this many small ready functions in a single request (default: no batching)')
+    parser.add_argument('--batch-tokens', type=int, default=2048, help='Maximum size of a batched prompt, in tokens')
+    parser.add_argument('--callee-tokens', type=int, default=CALLEE_TOKENS,
+                        help='Token budget for callee summaries in each prompt; less used callees beyond it are '
+                             'summarized in groups (0: no limit)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='openai',
+                        help='How to reach the model: the openai package, or pooled HTTP to any OpenAI-compatible API')
+    parser.add_argument('--base-url', default=None,
+                        help='API base URL, e.g. http://127.0.0.1:8000/v1 for mock_server.py (default: OpenAI)')
+    parser.add_argument('--model', default=MODEL, help=f'Model to use (default: {MODEL})')
+    parser.add_argument('--request-timeout', type=float, default=REQUEST_TIMEOUT,
+                        help='Give up on a response after this many seconds and retry (0: no limit)')
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                        help='Retries for timeouts and server errors before giving up on a request')
+    parser.add_argument('--retry-max-wait', type=float, default=RETRY_MAX_WAIT,
+                        help='Longest wait between retries, in seconds (waits are jittered)')
+    parser.add_argument('--hedge-percentile', type=int, default=None,
+                        help='Send a duplicate of any request slower than this percentile of recent ones '
+                             'and take whichever answers first (default: off)')
+    parser.add_argument('--hedge-max-fraction', type=float, default=0.1,
+                        help='Most duplicate requests to send, as a fraction of all requests')
+    parser.add_argument('--rpm', type=int, default=None, help='Maximum API requests per minute')
+    parser.add_argument('--tpm', type=int, default=None, help='Maximum API tokens (prompt + max_tokens) per minute')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help='Completion cache database (default: ~/.cache/gpt-wpre/completions.sqlite)')
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the completion cache")
+    parser.add_argument('--cache-max-mb', type=float, default=1024, help='Evict least recently used cache entries beyond this size')
+    parser.add_argument('--cache-max-age-days', type=float, default=None, help='Evict cache entries older than this')
+
+    parser.add_argument('--fingerprint-store', default=None,
+                        help='Database of summaries shared across binaries, keyed by normalized function fingerprints')
+    parser.add_argument('--incremental', metavar='PREV_PROGDIR', default=None,
+                        help='Reuse summaries from a previous version of the program, redoing only changed functions and their callers')
+    parser.add_argument('--prev-output', default=None,
+                        help='Summaries file in PREV_PROGDIR to reuse (default: same name as the output)')
+
+    parser.add_argument('--report', default=None,
+                        help='With several target functions, where to write their final summaries '
+                             '(default: OUTPUT with _report.json in place of .jsonl)')
+    parser.add_argument('--trace', default=None, help='Write a JSON line describing every request to this file')
+    parser.add_argument('--profile', action='store_true',
+                        help='At the end, show the most expensive functions and where the time went')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve live counters at http://127.0.0.1:PORT/metrics (Prometheus format)')
+    parser.add_argument('--graph-stats', action='store_true',
+                        help='Print call graph statistics (fan-in, fan-out, descendants) and exit')
 
     parser.add_argument('progdir')
     args = parser.parse_args()
     progdir = args.progdir
-    callgraph = json.load(open(os.path.join(progdir, args.call_graph)))
-    decompilations = json.load(open(os.path.join(progdir, args.decompilations)))
-    global DEBUG
+    graph, decompilations = load_inputs(progdir, args.call_graph, args.decompilations)
     DEBUG = args.verbose
+    CHUNKING = args.chunking
+    FAN_IN = args.fan_in
+    CHUNK_JOBS = max(args.jobs, FAN_IN)
+    SCC_PASSES = args.scc_passes
+    LATENCY_PER_CALL = args.latency
+    LATENCY_PER_TOKEN = args.latency_per_token
+    BATCH_SIZE = args.batch_size
+    BATCH_TOKENS = args.batch_tokens
+    CALLEE_TOKENS = args.callee_tokens or None
+    MODEL = args.model
+    if args.rpm or args.tpm:
+        RATE_LIMITER = RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+
+    if args.graph_stats:
+        print_graph_stats(graph)
+        return
 
-    if args.function is not None:
-        callgraph = subgraph(callgraph, args.function)
+    roots = target_functions(graph, args.function, args.functions_file, args.function_regex, parser.error)
+    if roots:
+        # One run over everything the targets call between them, so shared
+        # callees are only summarized once
+        callgraph = graph.subgraph(roots)
+        topo_order = summary_order(callgraph)
         if args.output is None:
-            args.output = f'summaries_{args.function}.jsonl'
+            if len(roots) == 1:
+                args.output = f'summaries_{roots[0]}.jsonl'
+            else:
+                # Named for the set of targets, so a run on a different set
+                # doesn't resume from (and add to) this one's output
+                digest = hashlib.sha256('\n'.join(sorted(roots)).encode()).hexdigest()[:10]
+                args.output = f'summaries_{len(roots)}_roots_{digest}.jsonl'
+        if len(roots) > 1:
+            separately = sum(len(graph.reachable([root])) for root in roots)
+            print(f'{len(roots)} target functions: {len(callgraph)} functions to summarize '
+                  f'({separately} if summarized one at a time)')
     else:
+        callgraph = graph.to_dict()
+        topo_order = graph.topo_order()
         if args.output is None:
             args.output = 'summaries.jsonl'
 
-    # TODO: handle non-trivial cycles
-    topo_order = list(graphlib.TopologicalSorter(callgraph).static_order())
-
     # Set up highlighting for C
     formatter = formatters.Terminal256Formatter(style='monokai')
     lexer = lexers.get_lexer_by_name('c')
@@ -269,10 +1454,60 @@ def main():
     else:
         from tqdm import tqdm
 
+    # In incremental mode, summaries of functions that haven't changed (and
+    # don't call anything that has) are carried over from the previous run
+    reused = {}
+    if args.incremental is not None:
+        prevdir = args.incremental
+        old_graph, old_decompilations = load_inputs(prevdir, args.call_graph, args.decompilations)
+        old_callgraph = old_graph.to_dict()
+        old_summaries = {}
+        with open(os.path.join(prevdir, args.prev_output or args.output)) as f:
+            for line in f:
+                old_summaries.update(json.loads(line))
+        changed = changed_functions(old_callgraph, old_decompilations, callgraph, decompilations)
+        dirty = dirty_functions(changed, callgraph)
+        reused = {func: summary for func, summary in old_summaries.items()
+                  if func in callgraph and func not in dirty}
+        print(f'Incremental: {len(changed)} functions changed, {len(dirty)} including callers; '
+              f'reusing {len(reused)} of {len(callgraph)} summaries.')
+
     if args.dry_run:
-        estimate_usage(callgraph, decompilations, max_lines=args.max_lines)
+        estimate_usage(callgraph, decompilations, max_lines=args.max_lines, already_summarized=reused, jobs=args.jobs)
         return
 
+    REQUEST_TIMEOUT = args.request_timeout or None
+    backend_args = {'timeout': REQUEST_TIMEOUT}
+    if args.base_url is not None:
+        backend_args['base_url'] = args.base_url
+    in_flight = max(1, args.jobs) * (CHUNK_JOBS if CHUNKING == 'mapreduce' else 1)
+    if args.backend == 'http':
+        # Enough keep-alive connections for every request that can be in flight
+        backend_args['pool_size'] = in_flight * (2 if args.hedge_percentile else 1)
+    BACKEND = make_backend(args.backend, **backend_args)
+    MAX_RETRIES = args.max_retries
+    RETRY_MAX_WAIT = args.retry_max_wait
+    if args.hedge_percentile:
+        HEDGER = HedgedRequests(percentile=args.hedge_percentile, max_fraction=args.hedge_max_fraction,
+                                workers=in_flight)
+
+    metrics_server = None
+    if args.trace is not None or args.profile or args.metrics_port is not None:
+        TRACER = Tracer(args.trace)
+        if args.metrics_port is not None:
+            metrics_server = MetricsServer(TRACER, args.metrics_port)
+
+    if not args.no_cache:
+        CACHE = SummaryCache(
+            args.cache,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+            max_age=(args.cache_max_age_days * 86400 if args.cache_max_age_days is not None else None),
+        )
+    if args.fingerprint_store is not None:
+        FINGERPRINT_STORE = FingerprintStore(args.fingerprint_store)
+        FINGERPRINTS = compute_fingerprints(callgraph, decompilations)
+        PROGRAM_NAME = os.path.basename(os.path.normpath(progdir))
+
     # Create the summaries by summarizing leaf functions first, then
     # working our way up the call graph; for non-leaf functions, we
     # use the summaries of the callees to help us summarize the function.
@@ -285,12 +1520,30 @@ def main():
                 js = json.loads(line)
                 summaries.update(js)
 
+    # Write carried-over summaries into the new output up front so that it's
+    # complete on its own (and so resuming an incremental run works as usual)
+    if reused:
+        with open(os.path.join(progdir, args.output), 'a') as f:
+            for func, summary in reused.items():
+                if func not in summaries:
+                    summaries[func] = summary
+                    f.write(json.dumps({ func: summary }) + '\n')
+
     with open(os.path.join(progdir, args.output), 'a') as f, \
         tqdm(total=len(topo_order)-len(summaries), desc="Summarizing functions") as pbar:
-        for summary in summarize_all(topo_order, callgraph, decompilations, max_lines=args.max_lines, already_summarized=summaries):
+        # Batching needs the concurrent scheduler to find functions that are ready together
+        if args.jobs > 1 or args.batch_size > 1:
+            results = summarize_all_concurrent(callgraph, decompilations, max_lines=args.max_lines,
+                                               already_summarized=summaries, jobs=args.jobs)
+        else:
+            results = summarize_all(topo_order, callgraph, decompilations, max_lines=args.max_lines,
+                                    already_summarized=summaries)
+        for summary in results:
             summaries.update(summary)
             f.write(json.dumps(summary) + '\n')
             f.flush()
+            if TRACER is not None:
+                TRACER.function_done()
 
             if args.verbose:
                 func_name = list(summary.keys())[0]
@@ -301,9 +1554,34 @@ def main():
                 # the progress bar is fake
                 pbar.update(1)
     print(f'Wrote {len(summaries)} summaries to {args.output}.')
-    if args.function is not None:
-        print(f'Final summary for {args.function}:')
-        print(summaries[args.function])
+    print(f'API requests: {STATS["requests"]} ({STATS["prompt_tokens"]} prompt tokens, '
+          f'{STATS["generated_tokens"]} generated); {STATS["overflows"]} prompts were too long.')
+    if FINGERPRINT_STORE is not None:
+        print(f'Fingerprint store: reused {FINGERPRINT_STORE.hits} summaries.')
+        FINGERPRINT_STORE.close()
+    if CACHE is not None:
+        stats = CACHE.stats()
+        print(f'Completion cache: {stats["hits"]} hits, {stats["misses"]} misses ({stats["entries"]} entries on disk).')
+        CACHE.close()
+    if STATS['timeouts']:
+        print(f'{STATS["timeouts"]} requests timed out after {REQUEST_TIMEOUT}s.')
+    if HEDGER is not None:
+        print(f'Hedging: sent {STATS["hedges"]} duplicate requests, {STATS["hedge_wins"]} of which answered first.')
+        HEDGER.close()
+    BACKEND.close()
+    if TRACER is not None:
+        if args.profile:
+            print(TRACER.profile())
+        if metrics_server is not None:
+            metrics_server.stop()
+        TRACER.close()
+    if len(roots) == 1:
+        print(f'Final summary for {roots[0]}:')
+        print(summaries[roots[0]])
+    elif roots:
+        report = args.report or os.path.join(progdir, re.sub(r'(\.jsonl)?$', '_report.json', args.output, count=1))
+        write_root_report(report, roots, graph, summaries)
+        print(f'Wrote final summaries of {len(roots)} target functions to {report}.')
 
 if __name__ == '__main__':
     main()
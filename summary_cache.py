@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Persistent cache of completions, keyed by a hash of everything that went into
+# the request (prompt, model, and generation parameters). Because the key is the
+# content rather than a function name, it doesn't matter which binary, output
+# file or -f target a prompt came from: if we've paid for it before, we don't
+# pay again. The chunk prompts from summarize_long_code go through the same
+# path, so partial work on big functions is reused too.
+#
+# SQLite takes care of concurrent access from other processes (WAL mode plus a
+# generous busy timeout); within a process all threads share one connection
+# guarded by a lock.
+class SummaryCache:
+    # Check the size limit every this many insertions
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_evict = 0
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS completions (
+            key TEXT PRIMARY KEY,
+            completion TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+        self.evict()
+
+    @staticmethod
+    def make_key(**params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT completion, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.max_age is not None and row[1] < time.time() - self.max_age):
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE completions SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, completion):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)',
+                              (key, completion, len(key) + len(completion.encode()), now, now))
+            self.puts_since_evict += 1
+            if self.puts_since_evict < self.EVICT_EVERY:
+                return
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.puts_since_evict = 0
+            if self.max_age is not None:
+                self.conn.execute('DELETE FROM completions WHERE created < ?', (time.time() - self.max_age,))
+            if self.max_bytes is None:
+                return
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            # Drop least recently used entries until we're back under the limit
+            doomed = []
+            for key, size in self.conn.execute('SELECT key, size FROM completions ORDER BY last_used'):
+                if total <= self.max_bytes:
+                    break
+                doomed.append((key,))
+                total -= size
+            self.conn.executemany('DELETE FROM completions WHERE key = ?', doomed)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
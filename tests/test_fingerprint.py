@@ -0,0 +1,24 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fingerprint import compute_fingerprints
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples', 'libpng16.so.16.38.0_stripped')
+
+def load_sample():
+    with open(os.path.join(SAMPLE, 'call_graph.json')) as f:
+        callgraph = json.load(f)
+    with open(os.path.join(SAMPLE, 'decompilations.json')) as f:
+        decompilations = json.load(f)
+    callgraph = {func: [callee for callee in callees if callee in decompilations]
+                 for func, callees in callgraph.items() if func in decompilations}
+    return callgraph, decompilations
+
+def test_flag_constants_keep_fingerprints_apart():
+    # These only differ in the flag they set (0x4000000, 0x2001000, 0x2001200)
+    callgraph, decompilations = load_sample()
+    fingerprints = compute_fingerprints(callgraph, decompilations)
+    funcs = ['png_set_scale_16', 'png_set_expand', 'png_set_expand_16']
+    assert len({fingerprints[func] for func in funcs}) == len(funcs)
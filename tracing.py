@@ -0,0 +1,180 @@
+import json
+import time
+import heapq
+import threading
+import contextlib
+import contextvars
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instrumentation for summarization runs: a JSONL record of every request
+# (what it was for, how big it was, how long it took and waited, whether it
+# was retried, came from the cache or was too long), an end-of-run profile of
+# where the time and tokens went, and live counters over HTTP for watching
+# long runs.
+
+# Fields attached to every request made while they're set (which function,
+# which strategy, ...). Context variables don't follow work into thread pools,
+# so code that fans out has to capture current_context() and pass it along.
+_context = contextvars.ContextVar('trace_context', default={})
+
+@contextlib.contextmanager
+def trace_context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def current_context():
+    return _context.get()
+
+class Tracer:
+    def __init__(self, path=None):
+        self.file = open(path, 'w') if path is not None else None
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.in_flight = 0
+        # Per function: requests, tokens, seconds in flight and waiting
+        self.functions = collections.defaultdict(collections.Counter)
+
+    @contextlib.contextmanager
+    def request(self, **fields):
+        # Times one summarize() call; the caller fills in the rest of the event
+        event = {'ts': round(time.time(), 3), **fields, 'prompt_tokens': 0, 'completion_tokens': 0,
+                 'latency': 0.0, 'queued': 0.0, 'attempts': 0, 'hedges': 0, 'hedge_wins': 0,
+                 'cache_hit': False, 'overflow': False}
+        with self.lock:
+            self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield event
+        except Exception as e:
+            event['error'] = type(e).__name__
+            raise
+        finally:
+            event['elapsed'] = round(time.monotonic() - start, 4)
+            event['latency'] = round(event['latency'], 4)
+            event['queued'] = round(event['queued'], 4)
+            event['retries'] = max(0, event['attempts'] - 1)
+            with self.lock:
+                self.in_flight -= 1
+                self.record(event)
+
+    def record(self, event):
+        # Called with the lock held
+        if self.file is not None:
+            self.file.write(json.dumps(event) + '\n')
+        counters = self.counters
+        counters['summarize_calls'] += 1
+        # Hedged duplicates are requests too, but not retries
+        requests = event['attempts'] + event['hedges']
+        counters['requests'] += requests
+        counters['hedges'] += event['hedges']
+        counters['hedge_wins'] += event['hedge_wins']
+        counters['cache_hits'] += event['cache_hit']
+        counters['overflows'] += event['overflow']
+        counters['retries'] += event['retries']
+        # Prompts that were too long are in the trace with their size, but
+        # were never paid for
+        tokens = 0 if event['overflow'] else event['prompt_tokens'] + event['completion_tokens']
+        counters['prompt_tokens'] += 0 if event['overflow'] else event['prompt_tokens']
+        counters['completion_tokens'] += event['completion_tokens']
+        counters['request_seconds'] += event['latency']
+        counters['rate_limit_seconds'] += event['queued']
+        # Batched requests are shared evenly between their functions
+        funcs = event.get('function') or ['(none)']
+        if isinstance(funcs, str):
+            funcs = [funcs]
+        for func in funcs:
+            stats = self.functions[func]
+            stats['requests'] += requests / len(funcs)
+            stats['tokens'] += tokens / len(funcs)
+            stats['request_seconds'] += event['latency'] / len(funcs)
+            stats['rate_limit_seconds'] += event['queued'] / len(funcs)
+
+    def scheduled(self, funcs, waited):
+        # Time between a function becoming ready and a worker picking it up
+        with self.lock:
+            self.counters['schedule_wait_seconds'] += waited * len(funcs)
+            self.counters['functions_scheduled'] += len(funcs)
+            for func in funcs:
+                self.functions[func]['schedule_wait_seconds'] += waited
+
+    def function_done(self):
+        with self.lock:
+            self.counters['functions_summarized'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            counters['requests_in_flight'] = self.in_flight
+        counters['elapsed_seconds'] = time.monotonic() - self.started
+        return counters
+
+    def profile(self, top=10):
+        counters = self.snapshot()
+        with self.lock:
+            functions = {func: dict(stats) for func, stats in self.functions.items()}
+        lines = ['===== Profile =====']
+        lines.append(f'Wall time: {counters["elapsed_seconds"]:.1f}s')
+        lines.append(f'Requests: {counters.get("requests", 0)} ({counters.get("retries", 0)} retries, '
+                     f'{counters.get("hedges", 0)} hedged, {counters.get("hedge_wins", 0)} by the hedge), '
+                     f'{counters.get("cache_hits", 0)} cache hits, {counters.get("overflows", 0)} too long')
+        lines.append(f'Tokens: {counters.get("prompt_tokens", 0)} prompt, {counters.get("completion_tokens", 0)} generated')
+        # Summed over requests/functions, so these can be more than the wall time
+        lines.append(f'Requests spent {counters.get("request_seconds", 0):.1f}s in flight '
+                     f'and {counters.get("rate_limit_seconds", 0):.1f}s waiting on the rate limiter')
+        if counters.get('functions_scheduled'):
+            waited = counters['schedule_wait_seconds']
+            lines.append(f'Functions spent {waited:.1f}s ready but waiting for a free worker '
+                         f'({waited / counters["functions_scheduled"]:.2f}s each on average)')
+        lines.append(f'Most expensive functions (of {len(functions)}):')
+        for func in heapq.nlargest(top, functions, key=lambda func: functions[func].get('tokens', 0)):
+            stats = functions[func]
+            lines.append(f'  {func}: {stats.get("tokens", 0):.0f} tokens in {stats.get("requests", 0):.1f} requests, '
+                         f'{stats.get("request_seconds", 0):.1f}s in flight, '
+                         f'{stats.get("rate_limit_seconds", 0) + stats.get("schedule_wait_seconds", 0):.1f}s queued')
+        return '\n'.join(lines)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        # Prometheus text format
+        lines = []
+        for name, value in sorted(self.server.tracer.snapshot().items()):
+            kind = 'gauge' if name in ('requests_in_flight', 'elapsed_seconds') else 'counter'
+            metric = f'wpre_{name}' if kind == 'gauge' else f'wpre_{name}_total'
+            lines.append(f'# TYPE {metric} {kind}')
+            lines.append(f'{metric} {value}')
+        body = ('\n'.join(lines) + '\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tracer, port, host='127.0.0.1'):
+        super().__init__((host, port), MetricsHandler)
+        self.tracer = tracer
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()